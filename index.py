@@ -1,14 +1,32 @@
 # index.py
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from pyrogram.errors import (
+    BadRequest, FloodWait, Forbidden, UserIsBlocked, InputUserDeactivated
+)
 import yt_dlp
 import os
 import config
 import asyncio
 import re
-import requests
+import unicodedata
 import time
 import json
+import heapq
+import contextvars
+from array import array
+import sqlite3
+import shutil
+from urllib.parse import urlsplit, parse_qs
+import tempfile
+import uuid
+import threading
+import multiprocessing
+import signal
+from collections import OrderedDict, deque
+from queue import Empty
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 # ----------------- CONFIG -----------------
@@ -17,27 +35,85 @@ MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
 ANTI_SPAM_COUNT = 5     # 5 ta so'rov
 ANTI_SPAM_WINDOW = 5 * 60  # 5 daqiqa (sekundda)
 ANTI_SPAM_PUNISH_DAYS = 1  # 1 kun ban
+BAN_EXPIRE_INTERVAL = 60   # muddati tugagan banlar har N sekundda olib tashlanadi
+ANTI_SPAM_CALLBACK_COUNT = 20      # tugma bosishlar ...
+ANTI_SPAM_CALLBACK_WINDOW = 60     # ... shuncha sekundda (oshsa — faqat rad etiladi)
+ANTI_SPAM_MAX_KEYS = 200_000       # xotirada kuzatiladigan foydalanuvchilar chegarasi
 WARN_LIMIT = 3
 WARN_BAN_DAYS = 1  # warn 3 → 1 kun ban
+DOWNLOAD_WORKERS = 2       # bir vaqtda ishlaydigan yt-dlp yuklashlar soni
+DOWNLOAD_PER_USER = 1      # bitta foydalanuvchining navbatdagi + ishlayotgan yuklashlari
+DOWNLOAD_POOL = "thread"   # "thread" yoki "process"
+SCALE_WORKERS = int(os.environ.get("SCALE_WORKERS", 0))  # 0 = bitta jarayon; N = dispatcher + N ta yuklovchi jarayon
+SCALE_WORKER_JOBS = 2      # har bir yuklovchi jarayonda parallel ishlar
+SCRATCH_DIR = "tmp"        # job ishchi papkalari (tmpfs bo'lishi mumkin, masalan /dev/shm/ytbot)
+MEDIA_DIR = "media"        # tayyor (keshlangan) fayllar
+MEDIA_CACHE_BYTES = 5 * 1024 * 1024 * 1024  # media papkasi uchun disk byudjeti
+MEDIA_CACHE_MAX_AGE_DAYS = 14   # shuncha kun ishlatilmagan kesh yozuvi o'chiriladi
+MEDIA_CACHE_POLICY = "lru"      # "lru" yoki "lfu"
+MEDIA_SWEEP_INTERVAL = 30 * 60  # tozalovchi har N sekundda
+MEDIA_SETTLE_SECONDS = 60 * 60  # bundan yangi fayllar (yuklanayotgan bo'lishi mumkin) tegilmaydi
+AUDIO_MODE = "passthrough"      # "passthrough" (m4a o'zgarishsiz) yoki "mp3" (har doim qayta kodlash)
+AUDIO_BITRATE = "192k"          # mp3 ga o'tkazishda
+FFMPEG_WORKERS = os.cpu_count() or 2  # bir vaqtda ishlaydigan ffmpeg jarayonlari
+FFMPEG_TIMEOUT = 10 * 60        # bitta ffmpeg ishi uchun, sekund
+SEARCH_RESULTS = 10             # "to'liq musiqa" uchun ko'rib chiqiladigan natijalar
+SEARCH_TIMEOUT = 20             # qidiruv uchun, sekund
+SEARCH_CACHE_TTL = 6 * 60 * 60  # bir xil qidiruv natijasi keshi
+SEARCH_CACHE_SIZE = 1000
+BAD_WORDS_RELOAD = 30           # taqiqlangan so'zlar fayli o'zgargani N sekundda tekshiriladi
+PENDING_TTL = 30 * 60      # URL yuborilgandan keyin tugmalar shuncha sekund ishlaydi
+PENDING_SIZE = 20_000      # xotiradagi kutilayotgan so'rovlar chegarasi
+PROGRESS_INTERVAL = 3      # status xabari ko'pi bilan N sekundda bir marta yangilanadi
+INFO_CACHE_TTL = 10 * 60   # metadata (extract_info) keshi, sekund
+INFO_CACHE_SIZE = 500      # keshdagi eng ko'p metadata soni
+STORAGE_BACKEND = "sqlite" # "sqlite" (WAL) yoki "json" (eski fayllar)
+JSON_FLUSH_INTERVAL = 5    # json rejimida fayllar har N sekundda yoziladi (0 = darhol)
+JSON_FLUSH_EVERY = 200     # ... yoki shuncha o'zgarishdan keyin, qaysi biri oldin bo'lsa
+HISTORY_SEGMENT_BYTES = 4 * 1024 * 1024  # tarix segmenti hajmi
+HISTORY_KEEP_PER_USER = 1000             # har bir foydalanuvchi uchun saqlanadigan yozuvlar
+HISTORY_RETENTION_DAYS = 365             # bundan eski yozuvlar compaction'da o'chadi
+HISTORY_COMPACT_INTERVAL = 60 * 60       # compaction har soatda
+HISTORY_PAGE_SIZE = 30
+API_RATE = 30               # barcha chiqish so'rovlari, so'rov/sekund
+API_CHAT_RATE = 1           # bitta chatga, so'rov/sekund
+API_CHAT_BURST = 3
+API_RETRIES = 3             # FloodWait'dan keyin qayta urinishlar
+BROADCAST_RATE = 25          # xabar/sekund (Telegram bot limiti ~30/s)
+BROADCAST_CONCURRENCY = 20   # parallel yuboruvchilar
+BROADCAST_RETRIES = 5        # FloodWait'dan keyin qayta urinishlar
+BROADCAST_REPORT_EVERY = 5   # progress va cursor har N sekundda saqlanadi
+DRAIN_TIMEOUT = 20           # SIGTERM: ishlayotgan yuklashlar shuncha sekund kutiladi
+PERF_SAMPLES = 2000          # /perf uchun har bir bosqich/label bo'yicha so'nggi o'lchovlar
+PERF_PROM_FILE = None        # masalan "metrics.prom" — Prometheus text formatida yoziladi
+PERF_DUMP_INTERVAL = 15      # ... har N sekundda
 
 # ----------------- FILE NAMES -----------------
 ADMINS_FILE = "admins.json"
 BANNED_FILE = "banned_users.json"
 WARNS_FILE = "warns.json"
-HISTORY_FILE = "history.json"
+BAD_WORDS_FILE = "bad_words.txt"  # bo'lmasa DEFAULT_BAD_WORDS ishlatiladi
+HISTORY_FILE = "history.json"  # eski format, faqat migratsiya uchun
+HISTORY_DIR = "history"
 CACHE_FILE = "cache.json"
 STATS_FILE = "stats.json"
+USERS_FILE = "users.json"
+BROADCAST_FILE = "broadcast.json"
+JOBS_FILE = "jobs.json"
+DB_FILE = "bot.db"
 
 # ----------------- IN-MEM -----------------
-user_links = {}        # user_id -> last url
-progress_messages = {} # message.id -> percent
 user_warnings = {}     # user_id -> int (kept in memory for quick access; persisted in WARNS_FILE)
-anti_spam = {}         # user_id -> list[timestamps]
-cache = {}             # url -> { "file": filepath, "type": "audio/video", "title": "...", "time": iso }
+cache = {}             # "extractor:id|variant" -> { "file": filepath, "type": "audio/video", "title": "...", "time": iso, "file_id": str }
 banned_users = {}      # loaded from BANNED_FILE
 admins = {}            # loaded from ADMINS_FILE
-history = {}           # loaded from HISTORY_FILE
 stats = {}             # loaded from STATS_FILE
+users = {}             # loaded from USERS_FILE (broadcast recipients)
+broadcasts = {}        # "current" -> running /sendall state (resumed after restart)
+jobs = {}              # job_id -> unfinished download (resumed after restart)
+warns_store = {}       # user_id -> [warn entries]
+store = None           # opened by init_state()
+history_log = None     # opened by init_state()
 
 # ----------------- UTIL: file load/save -----------------
 def ensure_file(path, default):
@@ -53,25 +129,546 @@ def load_json(path, default):
         except:
             return default
 
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-# initialize files
-admins = load_json(ADMINS_FILE, {})
-banned_users = load_json(BANNED_FILE, {})
-warns_store = load_json(WARNS_FILE, {})  # { user_id: [ { "time": iso, "reason": str, "source": "auto/manual" }, ... ] }
-history = load_json(HISTORY_FILE, {})    # { user_id: [ { "time": iso, "event": str, "note": str }, ... ] }
-cache = load_json(CACHE_FILE, {})        # { url: { "file": path, "type": "audio"/"video", "title": "", "time": iso } }
-stats = load_json(STATS_FILE, {"downloads":0, "audio":0, "video":0, "users":{}})
-
-# mirror warns_store to memory counts
-for uid, entries in warns_store.items():
+def write_atomic(path, text):
+    # temp file + fsync + rename: a crash leaves either the old or the new file
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(path) or ".")
     try:
-        user_warnings[int(uid)] = len(entries)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
     except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def save_json(path, data):
+    write_atomic(path, json.dumps(data, ensure_ascii=False, indent=2))
+
+# ----------------- STORAGE BACKEND -----------------
+# table -> (json file, name of the in-memory dict it mirrors)
+TABLES = {
+    "admins": (ADMINS_FILE, "admins"),
+    "bans": (BANNED_FILE, "banned_users"),
+    "warns": (WARNS_FILE, "warns_store"),
+    "cache": (CACHE_FILE, "cache"),
+    "stats": (STATS_FILE, "stats"),
+    "user_stats": (STATS_FILE, "stats"),  # stats["users"] in the json layout
+    "users": (USERS_FILE, "users"),
+    "broadcasts": (BROADCAST_FILE, "broadcasts"),
+    "jobs": (JOBS_FILE, "jobs"),
+}
+LIST_TABLES = ("warns",)  # key -> list of entries
+
+def write_many(payload):
+    for path, text in payload:
+        write_atomic(path, text)
+
+class JsonStore:
+    """One JSON file per table.
+
+    With interval=0 a table's file is rewritten on every change. Otherwise
+    changes only mark the table dirty and a background flusher writes each
+    dirty file once per `interval` seconds (or after `max_pending` changes),
+    doing the disk I/O off the event loop.
+    """
+
+    def __init__(self, interval=0, max_pending=0):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = None  # tables touched inside transaction()
+        self.dirty = set()
+        self.mutations = 0
+        self.wakeup = None
+        self.task = None
+
+    def load(self, table, default):
+        return load_json(TABLES[table][0], default)
+
+    def _save(self, table):
+        if self.pending is not None:
+            self.pending.add(table)
+        elif self.interval:
+            self._mark(table)
+        else:
+            path, name = TABLES[table]
+            save_json(path, globals()[name])
+
+    def _mark(self, table):
+        self.dirty.add(table)
+        self.mutations += 1
+        if self.wakeup and self.max_pending and self.mutations >= self.max_pending:
+            self.wakeup.set()
+
+    # the in-memory dict is already updated; the row itself is not needed here
+    def put(self, table, key, value):
+        self._save(table)
+
+    def delete(self, table, key):
+        self._save(table)
+
+    def append(self, table, key, entry):
+        self._save(table)
+
+    def clear(self, table, key):
+        self._save(table)
+
+    @contextmanager
+    def transaction(self):
+        """Group writes so each touched file is rewritten once."""
+        if self.pending is not None:
+            yield
+            return
+        self.pending = set()
+        try:
+            yield
+        finally:
+            tables, self.pending = self.pending, None
+            if self.interval:
+                for table in tables:
+                    self._mark(table)
+            else:
+                for path, name in {TABLES[t] for t in tables}:
+                    save_json(path, globals()[name])
+
+    def start(self):
+        if self.interval and self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._flusher())
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush_dirty()
+            except Exception as e:
+                print(f"json flush failed: {e}")
+
+    async def flush_dirty(self):
+        if not self.dirty:
+            return
+        tables, self.dirty, self.mutations = self.dirty, set(), 0
+        # serialize here, where the dicts are mutated; only the writes leave the loop
+        payload = [(path, json.dumps(globals()[name], ensure_ascii=False, indent=2))
+                   for path, name in {TABLES[t] for t in tables}]
+        try:
+            await run_blocking(write_many, payload)
+        except:
+            self.dirty |= tables
+            raise
+
+    def flush(self):
+        """Write every file now (startup / shutdown)."""
+        self.dirty, self.mutations = set(), 0
+        for path, name in set(TABLES.values()):
+            save_json(path, globals()[name])
+
+class SqliteStore:
+    """SQLite (WAL) store: every change is a single-row upsert/insert/delete."""
+
+    def __init__(self, path):
+        fresh = not os.path.exists(path)
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.depth = 0
+        for table in TABLES:
+            if table in LIST_TABLES:
+                self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value TEXT NOT NULL)")
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_key ON {table} (key, id)")
+            else:
+                self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if fresh:
+            self.import_json()
+
+    def load(self, table, default):
+        data = {}
+        if table in LIST_TABLES:
+            for key, value in self.db.execute(f"SELECT key, value FROM {table} ORDER BY id"):
+                data.setdefault(key, []).append(json.loads(value))
+        else:
+            for key, value in self.db.execute(f"SELECT key, value FROM {table}"):
+                data[key] = json.loads(value)
+        if table == "stats":
+            data = {**default, **data, "users": self.load("user_stats", {})}
+        return data
+
+    def put(self, table, key, value):
+        self.db.execute(f"INSERT INTO {table} (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        (str(key), json.dumps(value, ensure_ascii=False)))
+
+    def delete(self, table, key):
+        self.db.execute(f"DELETE FROM {table} WHERE key = ?", (str(key),))
+
+    def append(self, table, key, entry):
+        self.db.execute(f"INSERT INTO {table} (key, value) VALUES (?, ?)",
+                        (str(key), json.dumps(entry, ensure_ascii=False)))
+
+    def clear(self, table, key):
+        self.delete(table, key)
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one commit."""
+        self.depth += 1
+        if self.depth == 1:
+            self.db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute("ROLLBACK")
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.db.execute("COMMIT")
+
+    def start(self):
         pass
 
+    def flush(self):
+        self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def import_json(self):
+        """One-shot migration from the json files of the old layout."""
+        with self.transaction():
+            for table, (path, _) in TABLES.items():
+                if table == "user_stats" or not os.path.exists(path):
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except:
+                    continue
+                if table == "stats":
+                    for key, value in data.get("users", {}).items():
+                        self.put("user_stats", key, value)
+                    data = {k: v for k, v in data.items() if k != "users"}
+                for key, value in data.items():
+                    if table in LIST_TABLES:
+                        for entry in value:
+                            self.append(table, key, entry)
+                    else:
+                        self.put(table, key, value)
+
+def load_state():
+    """Open the store and load every table into memory."""
+    global store, admins, banned_users, warns_store, cache, stats, users, broadcasts, jobs
+    if STORAGE_BACKEND == "sqlite":
+        store = SqliteStore(DB_FILE)
+    else:
+        store = JsonStore(JSON_FLUSH_INTERVAL, JSON_FLUSH_EVERY)
+
+    admins = store.load("admins", {})
+    banned_users = store.load("bans", {})
+    warns_store = store.load("warns", {})  # { user_id: [ { "time": iso, "reason": str, "source": "auto/manual" }, ... ] }
+    cache = store.load("cache", {})        # { cache_key: { "file": path, "type": "audio"/"video", "title": "", "time": iso } }
+    stats = store.load("stats", {"downloads":0, "audio":0, "video":0, "users":{}})
+    users = store.load("users", {})
+    broadcasts = store.load("broadcasts", {})
+    jobs = store.load("jobs", {})
+
+    # mirror warns_store to memory counts
+    for uid, entries in warns_store.items():
+        try:
+            user_warnings[int(uid)] = len(entries)
+        except:
+            pass
+
+# ----------------- HISTORY LOG -----------------
+SEG_SHIFT = 40  # packed position = segment << 40 | byte offset
+
+def iso_epoch(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp())
+
+class UserHistory:
+    """Per-user index: packed position, epoch time and event id of each entry."""
+    __slots__ = ("pos", "ts", "ev")
+
+    def __init__(self):
+        self.pos = array("Q")
+        self.ts = array("q")
+        self.ev = array("H")
+
+class HistoryLog:
+    """Append-only history split into JSONL segments.
+
+    New entries go to the active segment, which is sealed (and gets a .idx
+    sidecar) once it passes `segment_bytes`. Only the small per-user index
+    lives in memory, so /history reads just the lines it shows. compact()
+    rewrites sealed segments without entries past the per-user cap or the
+    retention window.
+    """
+
+    def __init__(self, path: str, segment_bytes: int):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.users = {}      # user_id -> UserHistory
+        self.events = []     # event id -> name
+        self.event_ids = {}  # name -> event id
+        self.active_no = 1
+        self.fh = None
+        self.sealing = set()  # sealed segments whose sidecar is still being written
+        os.makedirs(path, exist_ok=True)
+        self.reindex()
+
+    def _seg(self, no: int) -> str:
+        return os.path.join(self.path, f"{no:06d}.jsonl")
+
+    def _idx(self, no: int) -> str:
+        return os.path.join(self.path, f"{no:06d}.idx")
+
+    def _segments(self):
+        return sorted(int(n[:-6]) for n in os.listdir(self.path) if n.endswith(".jsonl") and n[:-6].isdigit())
+
+    def _event_id(self, name: str) -> int:
+        eid = self.event_ids.get(name)
+        if eid is None:
+            eid = self.event_ids[name] = len(self.events)
+            self.events.append(name)
+        return eid
+
+    def _index(self, uid: str, no: int, offset: int, ts: int, event: str):
+        h = self.users.get(uid)
+        if h is None:
+            h = self.users[uid] = UserHistory()
+        h.pos.append(no << SEG_SHIFT | offset)
+        h.ts.append(ts)
+        h.ev.append(self._event_id(event))
+
+    def _scan(self, no: int):
+        """Index rows [user, offset, epoch, event] of one segment file."""
+        rows = []
+        offset = 0
+        with open(self._seg(no), "rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    try:
+                        e = json.loads(line)
+                        rows.append([e["user"], offset, iso_epoch(e["time"]), e["event"]])
+                    except (ValueError, KeyError):
+                        pass
+                offset += len(line)
+        return rows
+
+    def _write_sidecar(self, no: int):
+        rows = self._scan(no)
+        write_atomic(self._idx(no), json.dumps(rows, ensure_ascii=False))
+        return rows
+
+    def reindex(self):
+        self.users = {}
+        segs = self._segments() or [1]
+        self.active_no = segs[-1]
+        for no in segs:
+            if no == self.active_no:
+                if os.path.exists(self._seg(no)):
+                    self._drop_torn_tail(no)
+                    rows = self._scan(no)
+                else:
+                    rows = []
+            elif os.path.exists(self._idx(no)):
+                with open(self._idx(no), "r", encoding="utf-8") as f:
+                    rows = json.load(f)
+            else:
+                rows = self._write_sidecar(no)
+            for uid, offset, ts, event in rows:
+                self._index(uid, no, offset, ts, event)
+        if self.fh:
+            self.fh.close()
+        self.fh = open(self._seg(self.active_no), "ab")
+
+    def _drop_torn_tail(self, no: int):
+        # a crash mid-write can leave half a line; cut it so the next append starts clean
+        path = self._seg(no)
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def empty(self) -> bool:
+        return not self.users
+
+    def append(self, user_id, entry: dict):
+        uid = str(user_id)
+        line = (json.dumps(dict(entry, user=uid), ensure_ascii=False) + "\n").encode("utf-8")
+        offset = self.fh.tell()
+        self.fh.write(line)
+        self.fh.flush()
+        self._index(uid, self.active_no, offset, iso_epoch(entry["time"]), entry["event"])
+        if offset + len(line) >= self.segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        sealed = self.active_no
+        self.fh.close()
+        self.active_no += 1
+        self.fh = open(self._seg(self.active_no), "ab")
+        # the sidecar only speeds up the next startup; reindex rebuilds it if missing
+        try:
+            fut = asyncio.get_running_loop().run_in_executor(None, self._write_sidecar, sealed)
+        except RuntimeError:
+            self._write_sidecar(sealed)
+        else:
+            # a late write would put old offsets over a compacted sidecar: compact() waits for it
+            self.sealing.add(sealed)
+            fut.add_done_callback(lambda _: self.sealing.discard(sealed))
+
+    def query(self, user_id, event=None, since=None, until=None, page=1, per_page=30):
+        """Page of entries (oldest first within the page, newest page first) and the match total."""
+        h = self.users.get(str(user_id))
+        if h is None:
+            return [], 0
+        eid = None
+        if event is not None:
+            eid = self.event_ids.get(event)
+            if eid is None:
+                return [], 0
+        matches = [
+            i for i in range(len(h.pos) - 1, -1, -1)
+            if (eid is None or h.ev[i] == eid)
+            and (since is None or h.ts[i] >= since)
+            and (until is None or h.ts[i] < until)
+        ]
+        chosen = matches[(page - 1) * per_page:page * per_page]
+        entries = []
+        handles = {}
+        try:
+            for i in reversed(chosen):
+                no, offset = h.pos[i] >> SEG_SHIFT, h.pos[i] & ((1 << SEG_SHIFT) - 1)
+                f = handles.get(no)
+                if f is None:
+                    f = handles[no] = open(self._seg(no), "rb")
+                f.seek(offset)
+                e = json.loads(f.readline())
+                e.pop("user", None)
+                entries.append(e)
+        finally:
+            for f in handles.values():
+                f.close()
+        return entries, len(matches)
+
+    async def compact(self, keep_per_user: int, retention_days: int):
+        # the index walk, the rewrite and the new index entries all run off the loop
+        result = await run_blocking(self._compact, list(self.users.items()), self.active_no,
+                                    frozenset(self.sealing), keep_per_user,
+                                    time.time() - retention_days * 86400)
+        if result is None:
+            return
+        done, rebuilt = result
+        # swap files and index together on the loop so no read sees a mix
+        for no, kept in done:
+            if kept:
+                os.replace(self._seg(no) + ".compact", self._seg(no))
+                os.replace(self._idx(no) + ".compact", self._idx(no))
+            else:
+                for path in (self._seg(no), self._idx(no), self._seg(no) + ".compact", self._idx(no) + ".compact"):
+                    if os.path.exists(path):
+                        os.remove(path)
+        for uid, (h, n, new) in rebuilt.items():
+            # entries appended meanwhile are in the active segment, after everything else
+            new.pos.extend(h.pos[n:])
+            new.ts.extend(h.ts[n:])
+            new.ev.extend(h.ev[n:])
+            if new.pos:
+                self.users[uid] = new
+            else:
+                self.users.pop(uid, None)
+
+    def _compact(self, users, active_no: int, sealing, keep_per_user: int, cutoff: float):
+        """Rewrite sealed segments and build the index of every user they touch.
+
+        Returns None if there is nothing to drop, else ([(segment, kept anything)],
+        {uid: (old UserHistory, entries covered, new UserHistory)}).
+        """
+        mask = (1 << SEG_SHIFT) - 1
+        drop = {}   # sealed segment -> offsets to drop
+        sizes = {}  # uid -> entries seen; later ones are appended on the loop
+        for uid, h in users:
+            n = sizes[uid] = len(h.pos)
+            for i in range(n):
+                no = h.pos[i] >> SEG_SHIFT
+                if no < active_no and no not in sealing and (i < n - keep_per_user or h.ts[i] < cutoff):
+                    drop.setdefault(no, set()).add(h.pos[i] & mask)
+        if not drop:
+            return None
+        done = self._rewrite(drop)
+        fresh = {}  # uid -> (position, epoch, event id) kept in the rewritten segments
+        for no, rows in done:
+            for uid, offset, ts, event in rows:
+                fresh.setdefault(uid, []).append((no << SEG_SHIFT | offset, ts, self.event_ids[event]))
+        rebuilt = {}
+        for uid, h in users:
+            n = sizes[uid]
+            old = [(h.pos[i], h.ts[i], h.ev[i]) for i in range(n) if h.pos[i] >> SEG_SHIFT not in drop]
+            if len(old) == n and uid not in fresh:
+                continue  # nothing of this user was in a rewritten segment
+            new = UserHistory()
+            for pos, ts, ev in sorted(old + fresh.get(uid, [])):
+                new.pos.append(pos)
+                new.ts.append(ts)
+                new.ev.append(ev)
+            rebuilt[uid] = (h, n, new)
+        return [(no, bool(rows)) for no, rows in done], rebuilt
+
+    def _rewrite(self, drop: dict):
+        done = []
+        for no, offsets in drop.items():
+            rows = []
+            out = offset = 0
+            with open(self._seg(no), "rb") as src, open(self._seg(no) + ".compact", "wb") as dst:
+                for line in src:
+                    if offset not in offsets and line.endswith(b"\n"):
+                        e = json.loads(line)
+                        rows.append([e["user"], out, iso_epoch(e["time"]), e["event"]])
+                        dst.write(line)
+                        out += len(line)
+                    offset += len(line)
+                dst.flush()
+                os.fsync(dst.fileno())
+            write_atomic(self._idx(no) + ".compact", json.dumps(rows, ensure_ascii=False))
+            done.append((no, rows))
+        return done
+
+    async def compactor(self):
+        while True:
+            await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+            try:
+                await self.compact(HISTORY_KEEP_PER_USER, HISTORY_RETENTION_DAYS)
+            except Exception as e:
+                print(f"history compaction failed: {e}")
+
+def migrate_history():
+    """Move history from history.json / the old sqlite table into the log, once."""
+    if not history_log.empty():
+        return
+    legacy = []
+    if os.path.exists(HISTORY_FILE):
+        for uid, entries in load_json(HISTORY_FILE, {}).items():
+            legacy += [(uid, e) for e in entries]
+    if isinstance(store, SqliteStore):
+        try:
+            for uid, value in store.db.execute("SELECT key, value FROM history ORDER BY id"):
+                legacy.append((uid, json.loads(value)))
+        except sqlite3.OperationalError:
+            pass
+    seen = set()
+    for uid, e in sorted(legacy, key=lambda item: item[1].get("time", "")):
+        marker = (uid, e.get("time"), e.get("event"))
+        if marker in seen or "time" not in e or "event" not in e:
+            continue
+        seen.add(marker)
+        history_log.append(uid, e)
+
 # ----------------- PYROGRAM CLIENT -----------------
 app = Client(APP_NAME, api_id=config.API_ID, api_hash=config.API_HASH, bot_token=config.BOT_TOKEN)
 
@@ -85,54 +682,92 @@ def admin_level(user_id: int) -> int:
 
 def add_history(user_id: int, event: str, note: str = ""):
     s = {"time": now_iso(), "event": event, "note": note}
-    history.setdefault(str(user_id), []).append(s)
-    save_json(HISTORY_FILE, history)
+    history_log.append(user_id, s)
 
 def incr_stat(user_id: int, kind: str):
     stats["downloads"] = stats.get("downloads", 0) + 1
     stats[kind] = stats.get(kind, 0) + 1
     stats["users"].setdefault(str(user_id), 0)
     stats["users"][str(user_id)] += 1
-    save_json(STATS_FILE, stats)
+    with store.transaction():
+        store.put("stats", "downloads", stats["downloads"])
+        store.put("stats", kind, stats[kind])
+        store.put("user_stats", user_id, stats["users"][str(user_id)])
 
 def save_all():
-    save_json(ADMINS_FILE, admins)
-    save_json(BANNED_FILE, banned_users)
-    save_json(WARNS_FILE, warns_store)
-    save_json(HISTORY_FILE, history)
-    save_json(CACHE_FILE, cache)
-    save_json(STATS_FILE, stats)
+    store.flush()
 
 # ----------------- BAN / WARN LOGIC -----------------
+# expiry epochs are computed once; a check is a single dict lookup
+ban_expiry = {}   # uid -> epoch seconds (inf = permanent)
+ban_heap = []     # (epoch, uid) of timed bans; stale entries are skipped when popped
+
+def ban_epoch(until) -> float:
+    if until == "permanent":
+        return float("inf")
+    try:
+        return datetime.fromisoformat(until).timestamp()
+    except:
+        return 0.0
+
+def index_ban(uid: str, info: dict):
+    epoch = ban_epoch(info["until"])
+    ban_expiry[uid] = epoch
+    if epoch != float("inf"):
+        heapq.heappush(ban_heap, (epoch, uid))
+
 def is_user_banned(user_id: int) -> bool:
-    uid = str(user_id)
-    if uid not in banned_users:
-        return False
-    info = banned_users[uid]
-    if info["until"] == "permanent":
-        return True
-    until_dt = datetime.fromisoformat(info["until"])
-    if datetime.now() > until_dt:
-        del banned_users[uid]
-        save_json(BANNED_FILE, banned_users)
-        return False
-    return True
+    return ban_expiry.get(str(user_id), 0.0) > time.time()
 
 def ban_user(user_id: int, days=1, reason="Automatik/Manual ban"):
+    # days=None bans permanently
     uid = str(user_id)
-    if days == 0:
+    if days is None:
         until = "permanent"
     else:
         until = (datetime.now() + timedelta(days=days)).isoformat()
     banned_users[uid] = {"until": until, "reason": reason}
-    save_json(BANNED_FILE, banned_users)
+    index_ban(uid, banned_users[uid])
+    store.put("bans", uid, banned_users[uid])
     add_history(user_id, "ban", reason)
 
+def unban_user(user_id: int) -> bool:
+    uid = str(user_id)
+    if uid not in banned_users:
+        return False
+    del banned_users[uid]
+    ban_expiry.pop(uid, None)
+    store.delete("bans", uid)
+    return True
+
+def expire_bans(now=None) -> int:
+    """Lift every ban that has run out, persisting them in one batch."""
+    now = time.time() if now is None else now
+    expired = []
+    while ban_heap and ban_heap[0][0] <= now:
+        epoch, uid = heapq.heappop(ban_heap)
+        if ban_expiry.get(uid) == epoch:  # not re-banned or unbanned since
+            expired.append(uid)
+    if expired:
+        with store.transaction():
+            for uid in expired:
+                unban_user(uid)
+    return len(expired)
+
+async def ban_expirer():
+    while True:
+        await asyncio.sleep(BAN_EXPIRE_INTERVAL)
+        try:
+            expire_bans()
+        except Exception as e:
+            print(f"ban expiry failed: {e}")
+
+
 def warn_add(user_id: int, reason: str, source: str = "auto"):
     uid = str(user_id)
     entry = {"time": now_iso(), "reason": reason, "source": source}
     warns_store.setdefault(uid, []).append(entry)
-    save_json(WARNS_FILE, warns_store)
+    store.append("warns", uid, entry)
     user_warnings[user_id] = user_warnings.get(user_id, 0) + 1
     add_history(user_id, "warn", reason + f" (source={source})")
     # check limit
@@ -140,7 +775,7 @@ def warn_add(user_id: int, reason: str, source: str = "auto"):
         ban_user(user_id, WARN_BAN_DAYS, "3 warns reached")
         # clear warns after ban
         warns_store[uid] = []
-        save_json(WARNS_FILE, warns_store)
+        store.clear("warns", uid)
         user_warnings[user_id] = 0
         add_history(user_id, "auto-ban", "3 warns")
         return True  # banned
@@ -150,68 +785,757 @@ def warn_clear(user_id: int):
     uid = str(user_id)
     if uid in warns_store:
         warns_store[uid] = []
-        save_json(WARNS_FILE, warns_store)
+        store.clear("warns", uid)
     user_warnings[user_id] = 0
     add_history(user_id, "unwarn", "Cleared by admin")
 
 # ----------------- ANTI-SPAM -----------------
+class SpamWindow:
+    """Last `limit + 1` event times of one user in a fixed ring."""
+    __slots__ = ("times", "pos", "last")
+
+    def __init__(self, size):
+        self.times = [float("-inf")] * size
+        self.pos = 0
+        self.last = 0.0
+
+class SpamLimiter:
+    """Sliding-window limiter: O(1) per hit, idle users evicted in LRU order."""
+
+    def __init__(self, limit, window, max_keys=ANTI_SPAM_MAX_KEYS):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.windows = OrderedDict()  # user_id -> SpamWindow, least recently active first
+
+    def hit(self, user_id, now=None) -> int:
+        """Record an event; return how many events fall in the window if over the limit, else 0."""
+        now = time.time() if now is None else now
+        w = self.windows.pop(user_id, None)
+        self._evict(now)
+        if w is None:
+            w = SpamWindow(self.limit + 1)
+        self.windows[user_id] = w
+        w.times[w.pos] = now
+        w.pos = (w.pos + 1) % len(w.times)
+        w.last = now
+        # the slot we'll overwrite next is the oldest of the last limit+1 events
+        if w.times[w.pos] > now - self.window:
+            return self.limit + 1
+        return 0
+
+    def _evict(self, now):
+        # a user idle for a whole window has nothing left to count
+        cutoff = now - self.window
+        windows = self.windows
+        while windows:
+            uid, w = next(iter(windows.items()))
+            if w.last > cutoff and len(windows) < self.max_keys:
+                break
+            del windows[uid]
+
+    def __len__(self):
+        return len(self.windows)
+
+text_limiter = SpamLimiter(ANTI_SPAM_COUNT, ANTI_SPAM_WINDOW)
+callback_limiter = SpamLimiter(ANTI_SPAM_CALLBACK_COUNT, ANTI_SPAM_CALLBACK_WINDOW)
+
 def anti_spam_record(user_id: int) -> bool:
     """Record event, return True if punish (ban) required."""
-    now_ts = time.time()
-    lst = anti_spam.setdefault(str(user_id), [])
-    # remove old timestamps outside window
-    cutoff = now_ts - ANTI_SPAM_WINDOW
-    lst = [t for t in lst if t >= cutoff]
-    lst.append(now_ts)
-    anti_spam[str(user_id)] = lst
-    # punish if length > threshold
-    if len(lst) > ANTI_SPAM_COUNT:
+    count = text_limiter.hit(user_id)
+    if count:
         # punish: 1 day ban
-        ban_user(user_id, ANTI_SPAM_PUNISH_DAYS, f"Anti-spam: {len(lst)} in {ANTI_SPAM_WINDOW//60}min")
-        add_history(user_id, "antispam-ban", f"{len(lst)} msg in {ANTI_SPAM_WINDOW} sec")
+        ban_user(user_id, ANTI_SPAM_PUNISH_DAYS, f"Anti-spam: {count} in {ANTI_SPAM_WINDOW//60}min")
+        add_history(user_id, "antispam-ban", f"{count} msg in {ANTI_SPAM_WINDOW} sec")
         return True
     return False
 
+def callback_throttled(user_id: int) -> bool:
+    # button presses are only slowed down, not punished
+    return bool(callback_limiter.hit(user_id))
+
 # ----------------- EXPLICIT TITLE CHECK -----------------
+# one term per line, '#' comments; a trailing '*' matches any word ending ("porn*" -> "pornhub")
+DEFAULT_BAD_WORDS = [
+    "18+", "sex", "porn*", "xxx", "nude*", "boobs", "adult", "fuck*",
+    "erotic*", "nsfw", "sexy", "hardcore", "naked", "hot video", "anal",
+    "onlyfans",
+]
+LEET = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t",
+                      "@": "a", "$": "s"})
+
+def normalize_text(text: str) -> str:
+    # fold accents/fullwidth forms and leetspeak, squeeze separators to single spaces
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower().translate(LEET)
+    return " ".join(re.sub(r"[^\w+]+", " ", text).split())
+
+class WordMatcher:
+    """Aho–Corasick automaton over normalized terms: one pass per text, however long the list."""
+
+    def __init__(self, terms):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # node -> [(term length, needs right boundary)]
+        for term in terms:
+            prefix = term.endswith("*")
+            term = normalize_text(term.rstrip("*"))
+            if term:
+                self._add(term, not prefix)
+        self._link()
+
+    def _add(self, term, bounded):
+        node = 0
+        for ch in term:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append((len(term), bounded))
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+    def search(self, text: str):
+        """First matched term in already-normalized `text`, or None."""
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, bounded in out[node]:
+                start = i - length + 1
+                # whole words only: "sex" must not hit "sussex", "anal" not "analysis"
+                if start > 0 and text[start - 1] != " ":
+                    continue
+                if bounded and i + 1 < len(text) and text[i + 1] != " ":
+                    continue
+                return text[start:i + 1]
+        return None
+
+class ExplicitFilter:
+    """Word list compiled once; reloaded when its file changes on disk."""
+
+    def __init__(self, path, defaults, check_every=BAD_WORDS_RELOAD):
+        self.path = path
+        self.defaults = defaults
+        self.check_every = check_every
+        self.mtime = None
+        self.checked = 0.0
+        self.matcher = WordMatcher(defaults)
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        terms = self.defaults
+        if mtime is not None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    terms = [l.strip() for l in f if l.strip() and not l.lstrip().startswith("#")]
+            except:
+                return  # keep the current automaton
+        self.matcher = WordMatcher(terms)
+        self.mtime = mtime
+
+    def match(self, *texts):
+        now = time.time()
+        if now - self.checked >= self.check_every:
+            self.checked = now
+            self.reload()
+        for text in texts:
+            hit = self.matcher.search(normalize_text(text)) if text else None
+            if hit:
+                return hit
+        return None
+
+explicit_filter = ExplicitFilter(BAD_WORDS_FILE, DEFAULT_BAD_WORDS)
+
 def is_explicit_title(title: str) -> bool:
-    if not title:
-        return False
-    bad_words = [
-        "18+", "sex", "porn", "xxx", "nude", "boobs", "adult", "fuck",
-        "erotic", "nsfw", "sexy", "hardcore", "naked", "hot video", "anal",
-        "pornhub", "onlyfans"
-    ]
-    tl = title.lower()
-    return any(w in tl for w in bad_words)
-
-# ----------------- PROGRESS HOOK -----------------
-async def progress_hook(d, message):
-    if d.get('status') != 'downloading':
-        return
-    percent = d.get('_percent_str', '0.0%').strip()
+    return bool(title) and explicit_filter.match(title) is not None
+
+def is_explicit_info(info: dict) -> bool:
+    # title, description and tags all come with the metadata we already fetched
+    tags = info.get("tags") or []
+    return explicit_filter.match(info.get("title"), " ".join(tags), info.get("description")) is not None
+
+# ----------------- PROGRESS REPORTER -----------------
+def progress_text(d) -> str:
     total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
-    downloaded = d.get('downloaded_bytes', 0)
-    if total_bytes:
-        done_mb = downloaded / (1024 * 1024)
-        total_mb = total_bytes / (1024 * 1024)
-        text = f"📥 Yuklanmoqda... {percent}\n💾 {done_mb:.1f} MB / {total_mb:.1f} MB"
-    else:
-        text = f"📥 Yuklanmoqda... {percent}"
-    try:
-        mid = message.id
-        if mid not in progress_messages or progress_messages[mid] != percent:
-            progress_messages[mid] = percent
-            await message.edit_text(text)
-    except:
-        pass
+    downloaded = d.get('downloaded_bytes') or 0
+    if not total_bytes:
+        return f"📥 Yuklanmoqda... {downloaded / (1024 * 1024):.1f} MB"
+    text = (f"📥 Yuklanmoqda... {downloaded * 100 / total_bytes:.1f}%\n"
+            f"💾 {downloaded / (1024 * 1024):.1f} MB / {total_bytes / (1024 * 1024):.1f} MB")
+    speed, eta = d.get('speed'), d.get('eta')
+    if speed:
+        text += f"\n⚡ {speed / (1024 * 1024):.1f} MB/s"
+    if eta is not None:
+        text += f" · ⏳ {int(eta) // 60}:{int(eta) % 60:02d}"
+    return text
+
+class ProgressReporter:
+    """Edits a job's status messages with its latest progress, at most once per `interval`.
+
+    hook() runs on the download thread and only stores the newest sample;
+    the edit itself is scheduled on the loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, messages: list, interval: float):
+        self.messages = messages  # shared with the job: late joiners get updates too
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.latest = None
+        self.scheduled = False
+        self.last_edit = 0.0
+        self.last_text = None
+        self.closed = False
+
+    def hook(self, d):
+        if d.get('status') != 'downloading' or self.closed:
+            return
+        self.latest = d
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        delay = max(0.0, self.last_edit + self.interval - time.monotonic())
+        self.loop.call_later(delay, lambda: self.loop.create_task(self._flush()))
+
+    async def _flush(self):
+        self.scheduled = False
+        if self.closed or self.latest is None:
+            return
+        api_priority.set(PRIO_LOW)  # this task only; skipped when the bot is over budget
+        text = progress_text(self.latest)
+        if text == self.last_text:
+            return
+        self.last_text = text
+        self.last_edit = time.monotonic()
+        for m in list(self.messages):
+            try:
+                await m.edit_text(text)
+            except:
+                pass
+
+    def close(self):
+        # later samples and pending edits are dropped; the final status is the caller's
+        self.closed = True
+
+# ----------------- TTL CACHE -----------------
+class TTLCache:
+    """Size-bounded LRU map whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        if item[0] < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def __len__(self):
+        return len(self.data)
+
+# ----------------- PENDING REQUESTS -----------------
+# every pasted link gets its own token, so several keyboards can be used side by side
+pending_requests = TTLCache(PENDING_SIZE, PENDING_TTL)  # token -> request dict
+
+def new_request(user_id: int, url: str) -> str:
+    token = uuid.uuid4().hex[:12]
+    pending_requests.set(token, {"uid": user_id, "url": url, "info": None, "kind": None, "quality": None})
+    return token
+
+def get_request(user_id: int, data: str):
+    """Split callback_data "action:token" and return (action, request) for this user."""
+    action, _, token = data.partition(":")
+    req = pending_requests.get(token)
+    if req is None or req["uid"] != user_id:
+        return action, None
+    return action, req
+
+# ----------------- PERF METRICS -----------------
+PERF_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+PERF_WINDOWS = {"5m": 5 * 60, "1h": 60 * 60, "24h": 24 * 60 * 60}
+
+class Metrics:
+    """Per-stage latency histograms and counters, labelled by extractor and quality.
+
+    Buckets/sums are lifetime (for Prometheus); recent samples feed the /perf percentiles.
+    """
+
+    def __init__(self, samples: int):
+        self.max_samples = samples
+        self.samples = {}   # (stage, extractor, quality) -> deque[(monotonic, seconds, bytes)]
+        self.buckets = {}   # same key -> cumulative counts per PERF_BUCKETS (+Inf last)
+        self.totals = {}    # same key -> [count, seconds]
+        self.counters = {}  # (name, extractor, quality) -> value
+
+    def observe(self, stage, seconds, extractor="-", quality="-", nbytes=0):
+        key = (stage, extractor, quality or "-")
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.max_samples)
+            self.buckets[key] = [0] * (len(PERF_BUCKETS) + 1)
+            self.totals[key] = [0, 0.0]
+        self.samples[key].append((time.monotonic(), seconds, nbytes))
+        if nbytes:
+            self.incr(f"{stage}_bytes", nbytes, extractor, quality)
+        counts = self.buckets[key]
+        for i, bound in enumerate(PERF_BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.totals[key][0] += 1
+        self.totals[key][1] += seconds
+
+    def incr(self, name, value=1, extractor="-", quality="-"):
+        key = (name, extractor, quality or "-")
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage, extractor="-", quality="-"):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, extractor, quality)
+
+    def recent(self, window, stage=None):
+        """{(stage, extractor, quality): [(seconds, bytes), ...]} from the last `window` seconds."""
+        cutoff = time.monotonic() - window
+        out = {}
+        for key, dq in self.samples.items():
+            if stage and key[0] != stage:
+                continue
+            values = [(s, b) for t, s, b in dq if t >= cutoff]
+            if values:
+                out[key] = values
+        return out
+
+    def prometheus(self) -> str:
+        lines = ["# TYPE bot_stage_seconds histogram"]
+        for (stage, extractor, quality), counts in sorted(self.buckets.items()):
+            labels = f'stage="{stage}",extractor="{extractor}",quality="{quality}"'
+            for bound, n in zip(PERF_BUCKETS, counts):
+                lines.append(f'bot_stage_seconds_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'bot_stage_seconds_bucket{{{labels},le="+Inf"}} {counts[-1]}')
+            count, total = self.totals[(stage, extractor, quality)]
+            lines.append(f"bot_stage_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"bot_stage_seconds_count{{{labels}}} {count}")
+        for name in sorted({k[0] for k in self.counters}):
+            lines.append(f"# TYPE bot_{name}_total counter")
+            for (n, extractor, quality), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f'bot_{name}_total{{extractor="{extractor}",quality="{quality}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+perf = Metrics(PERF_SAMPLES)
+
+async def perf_dumper():
+    # textfile for node_exporter's collector (or any scraper that reads files)
+    while True:
+        await asyncio.sleep(PERF_DUMP_INTERVAL)
+        try:
+            write_atomic(PERF_PROM_FILE, perf.prometheus())
+        except Exception as e:
+            print(f"perf dump failed: {e}")
+
+# ----------------- URL NORMALIZATION -----------------
+YT_HOSTS = ("youtube.com", "youtu.be", "youtube-nocookie.com")
+YT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+IG_KINDS = ("p", "reel", "reels", "tv")
+TRACKING_PARAMS = {"si", "feature", "pp", "igsh", "igshid", "fbclid", "gclid", "ref"}
+
+def canonical_url(url: str) -> str:
+    """Map a pasted link to a stable "extractor:media_id" key.
+
+    Covers youtube watch/shorts/embed/live/youtu.be and instagram p/reel/tv
+    links; anything else becomes its URL without tracking params.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = [p for p in parts.path.split("/") if p]
+    if host in YT_HOSTS:
+        vid = None
+        if host == "youtu.be" and path:
+            vid = path[0]
+        elif len(path) >= 2 and path[0] in ("shorts", "embed", "live", "v"):
+            vid = path[1]
+        else:
+            vid = (parse_qs(parts.query).get("v") or [None])[0]
+        if vid and YT_ID_RE.match(vid):
+            return f"youtube:{vid}"
+    if host in ("instagram.com", "instagr.am"):
+        for i, seg in enumerate(path[:-1]):
+            if seg in IG_KINDS:
+                return f"instagram:{path[i + 1]}"
+    query = "&".join(
+        q for q in parts.query.split("&")
+        if q and q.split("=", 1)[0].lower() not in TRACKING_PARAMS and not q.lower().startswith("utm_")
+    )
+    return f"url:{host}{parts.path.rstrip('/')}" + (f"?{query}" if query else "")
+
+def media_variant(kind: str, quality: str = None) -> str:
+    # "audio", "video:360", "video:best", ...
+    return kind if kind == "audio" else f"video:{quality or 'best'}"
+
+def cache_key(url: str, variant: str) -> str:
+    return f"{canonical_url(url)}|{variant}"
 
 # ----------------- CACHE HELPERS -----------------
-def cache_get(url: str):
-    return cache.get(url)
+def cache_get(url: str, variant: str):
+    key = cache_key(url, variant)
+    c = cache.get(key)
+    if c:
+        # usage for LRU/LFU eviction
+        c["hits"] = c.get("hits", 0) + 1
+        c["last_hit"] = time.time()
+        store.put("cache", key, c)
+    return c
+
+def cache_set(url: str, variant: str, file_path: str, kind: str, title: str, file_id=None, file_unique_id=None):
+    key = cache_key(url, variant)
+    cache[key] = {"file": file_path, "type": kind, "title": title, "time": now_iso(),
+                  "file_id": file_id, "file_unique_id": file_unique_id, "hits": 0, "last_hit": time.time()}
+    store.put("cache", key, cache[key])
+    return cache[key]
+
+def cache_usable(c) -> bool:
+    # a Telegram file_id stays valid even after the local file is gone
+    return bool(c) and (bool(c.get("file_id")) or os.path.exists(c.get("file", "")))
+
+def sent_file_ids(sent, kind: str):
+    """(file_id, file_unique_id) of the media in a message we just sent."""
+    media = getattr(sent, kind, None) or getattr(sent, "document", None)
+    if not media:
+        return None, None
+    return media.file_id, media.file_unique_id
+
+async def send_media(message, kind: str, media: str, caption: str):
+    if kind == "audio":
+        return await message.reply_audio(media, caption=caption)
+    return await message.reply_video(media, caption=caption)
+
+async def send_cached(message, key: str, c: dict, kind: str) -> bool:
+    """Re-send a cache entry by file_id, falling back to re-uploading the local file.
 
-def cache_set(url: str, file_path: str, kind: str, title: str):
-    cache[url] = {"file": file_path, "type": kind, "title": title, "time": now_iso()}
-    save_json(CACHE_FILE, cache)
+    Returns False when neither works and the media has to be downloaded again.
+    """
+    caption = c.get("title") or ("Audio (cache)" if kind == "audio" else "Video (cache)")
+    if c.get("file_id"):
+        try:
+            await send_media(message, kind, c["file_id"], caption)
+            return True
+        except BadRequest:
+            # Telegram no longer knows this id — forget it and upload again
+            c["file_id"] = c["file_unique_id"] = None
+    if not os.path.exists(c.get("file", "")):
+        return False
+    sent = await send_media(message, kind, c["file"], caption)
+    c["file_id"], c["file_unique_id"] = sent_file_ids(sent, kind)
+    store.put("cache", key, c)
+    return True
+
+# ----------------- FORMAT PLANNER -----------------
+def human_size(n: int) -> str:
+    if n >= 1024 ** 3:
+        return f"{n / 1024 ** 3:.1f} GB"
+    return f"{n / 1024 ** 2:.0f} MB"
+
+def estimate_size(f: dict, duration):
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size:
+        return int(size)
+    if f.get("tbr") and duration:
+        return int(f["tbr"] * 1000 / 8 * duration)  # tbr is kbit/s
+    return None
+
+def has_codec(f: dict, key: str) -> bool:
+    return f.get(key) not in (None, "none")
+
+def format_candidates(info: dict, kind: str, quality: str = None):
+    """(yt-dlp selector fallback, [(rank, format_spec, estimated_bytes or None), ...])."""
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    audios = [f for f in formats if has_codec(f, "acodec") and f.get("vcodec") == "none"]
+    if kind == "audio":
+        # passthrough mode prefers AAC, which needs no transcode
+        prefer_aac = AUDIO_MODE == "passthrough"
+        fallback = "bestaudio[ext=m4a]/bestaudio/best" if prefer_aac else "bestaudio/best"
+        candidates = [((prefer_aac and (f.get("acodec") or "").startswith("mp4a"), f.get("abr") or f.get("tbr") or 0),
+                       f["format_id"], estimate_size(f, duration))
+                      for f in audios]
+    else:
+        fallback = "bestvideo+bestaudio/best" if quality == "best" else f"bestvideo[height<={quality}]+bestaudio/best/best"
+        limit = None if quality in (None, "best") else int(quality)
+        videos = [f for f in formats if has_codec(f, "vcodec") and (limit is None or (f.get("height") or 0) <= limit)]
+        candidates = []
+        for v in videos:
+            v_size = estimate_size(v, duration)
+            rank = (v.get("height") or 0, v.get("tbr") or 0)
+            if has_codec(v, "acodec"):
+                candidates.append((rank + (0,), v["format_id"], v_size))
+                continue
+            for a in audios:
+                a_size = estimate_size(a, duration)
+                size = v_size + a_size if v_size and a_size else None
+                candidates.append((rank + (a.get("abr") or 0,), f"{v['format_id']}+{a['format_id']}", size))
+    return fallback, candidates
+
+def plan_format(info: dict, kind: str, quality: str = None):
+    """Pick the best format (or video+audio pair) predicted to fit MAX_FILE_SIZE.
+
+    Returns (format_spec, estimated_bytes). A None spec means nothing fits and
+    the estimate is the smallest candidate; a None estimate means the formats
+    carry no size info and the spec is yt-dlp's usual selector.
+    """
+    fallback, candidates = format_candidates(info, kind, quality)
+    sized = [c for c in candidates if c[2]]
+    if not sized:
+        return fallback, None
+    for _, spec, size in sorted(sized, key=lambda c: c[0], reverse=True):
+        if size <= MAX_FILE_SIZE:
+            return spec, size
+    if len(sized) < len(candidates):
+        # some formats have no size info; let yt-dlp try and check afterwards
+        return fallback, None
+    return None, min(c[2] for c in sized)
+
+def quality_label(info: dict, quality: str) -> str:
+    """Button text for what plan_format will send: its size, the height it falls back to, or ❌."""
+    name = "🔝 Eng yuqori" if quality == "best" else f"{quality}p"
+    spec, size = plan_format(info, "video", quality)
+    if spec is None:
+        return f"{name} ❌ ~{human_size(size)}"
+    if size is None:
+        return name
+    _, candidates = format_candidates(info, "video", quality)
+    top = max(c[0][0] for c in candidates)
+    height = next(c[0][0] for c in candidates if c[1] == spec)
+    if height < top:
+        # the top format is over the limit; say which one the button really sends
+        return f"{name} → {height}p ~{human_size(size)}"
+    return f"{name} ~{human_size(size)}"
+
+# ----------------- AUDIO PIPELINE -----------------
+PLAYABLE_AUDIO = (".m4a", ".mp3")  # what Telegram's music player takes as is
+
+class FFmpegPool:
+    """Runs ffmpeg with at most `size` processes at once; later jobs wait their turn."""
+
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self.sem = None
+        self.waiting = 0
+
+    async def run(self, *args):
+        if self.sem is None:
+            self.sem = asyncio.Semaphore(self.size)
+        self.waiting += 1
+        try:
+            await self.sem.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-y", "-loglevel", "error", *args,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            try:
+                _, err = await asyncio.wait_for(proc.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise RuntimeError("ffmpeg: vaqt tugadi")
+            except asyncio.CancelledError:
+                proc.kill()
+                raise
+            if proc.returncode != 0:
+                raise RuntimeError(f"ffmpeg: {err.decode(errors='ignore').strip()[-200:]}")
+        finally:
+            self.sem.release()
+
+ffmpeg_pool = FFmpegPool(FFMPEG_WORKERS, FFMPEG_TIMEOUT)
+
+async def prepare_audio(path: str, info: dict) -> str:
+    """Turn a downloaded file into something send_audio can play.
+
+    In passthrough mode m4a/mp3 go out untouched and AAC inside another
+    container is only remuxed; everything else is transcoded to mp3.
+    """
+    base, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if AUDIO_MODE == "passthrough":
+        if ext in PLAYABLE_AUDIO:
+            return path
+        if (info.get("acodec") or "").startswith("mp4a"):
+            await ffmpeg_pool.run("-i", path, "-vn", "-c:a", "copy", base + ".m4a")
+            return base + ".m4a"
+    elif ext == ".mp3":
+        return path
+    await ffmpeg_pool.run("-i", path, "-vn", "-c:a", "libmp3lame", "-b:a", AUDIO_BITRATE, base + ".mp3")
+    return base + ".mp3"
+
+# ----------------- MEDIA CACHE EVICTION -----------------
+FRAGMENT_RE = re.compile(r"\.f\d+\.\w+$|\.part$|\.ytdl$|\.temp\.\w+$")
+
+def entry_last_used(c) -> float:
+    return c.get("last_hit") or iso_epoch(c["time"])
+
+def media_scan(paths):
+    """(sizes of existing cached files, {media dir file: mtime}, {fragment: mtime})."""
+    sizes = {p: os.path.getsize(p) for p in paths if p and os.path.isfile(p)}
+    on_disk, fragments = {}, {}
+    for folder in (MEDIA_DIR, "."):
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name) if folder != "." else name
+            if not os.path.isfile(path):
+                continue
+            if FRAGMENT_RE.search(name):
+                fragments[path] = os.path.getmtime(path)
+            elif folder == MEDIA_DIR:
+                on_disk[path] = os.path.getmtime(path)
+    return sizes, on_disk, fragments
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def forget_file(key: str, c: dict):
+    # the entry survives without its file as long as Telegram has a file_id for it
+    if c.get("file_id"):
+        c["file"] = ""
+        store.put("cache", key, c)
+    else:
+        del cache[key]
+        store.delete("cache", key)
+
+async def sweep_media_cache():
+    """Reconcile the cache with the disk, then apply MEDIA_CACHE_MAX_AGE_DAYS and MEDIA_CACHE_BYTES."""
+    now = time.time()
+    sizes, on_disk, fragments = await run_blocking(media_scan, [c.get("file", "") for c in cache.values()])
+    # files younger than this may belong to a job that has not called cache_set yet
+    settled = now - MEDIA_SETTLE_SECONDS
+    doomed = {p for p, mtime in fragments.items() if mtime < settled}
+    freed = 0
+    with store.transaction():
+        for key, c in list(cache.items()):
+            path = c.get("file", "")
+            if "|" not in key or now - entry_last_used(c) > MEDIA_CACHE_MAX_AGE_DAYS * 86400:
+                # pre-canonical raw-URL keys, or unused for too long
+                if path in on_disk:
+                    doomed.add(path)
+                del cache[key]
+                store.delete("cache", key)
+            elif path and path not in sizes:
+                forget_file(key, c)
+        referenced = {c.get("file") for c in cache.values()}
+        doomed |= {p for p, mtime in on_disk.items() if p not in referenced and mtime < settled}
+        cached = [(key, c) for key, c in cache.items() if c.get("file") in sizes]
+        total = sum(sizes[c["file"]] for _, c in cached)
+        if total > MEDIA_CACHE_BYTES:
+            if MEDIA_CACHE_POLICY == "lfu":
+                cached.sort(key=lambda kc: (kc[1].get("hits", 0), entry_last_used(kc[1])))
+            else:
+                cached.sort(key=lambda kc: entry_last_used(kc[1]))
+            for key, c in cached:
+                if total <= MEDIA_CACHE_BYTES:
+                    break
+                if now - entry_last_used(c) < MEDIA_SETTLE_SECONDS:
+                    continue  # may be uploading right now
+                total -= sizes[c["file"]]
+                freed += sizes[c["file"]]
+                doomed.add(c["file"])
+                forget_file(key, c)
+    await run_blocking(remove_files, sorted(doomed))
+    return len(doomed), freed
+
+async def media_sweeper():
+    while True:
+        try:
+            await sweep_media_cache()
+        except Exception as e:
+            print(f"media cache sweep failed: {e}")
+        await asyncio.sleep(MEDIA_SWEEP_INTERVAL)
+
+# ----------------- DOWNLOAD ENGINE -----------------
+# yt-dlp transfer settings; an extractor profile overrides "default"
+ENGINE_PROFILES = {
+    "default": {
+        "concurrent_fragment_downloads": 4,   # DASH/HLS bo'laklari parallel
+        "http_chunk_size": 10 * 1024 * 1024,  # YouTube throttlingini chetlab o'tadi
+        "buffersize": 1024 * 1024,
+        "retries": 5,
+        "fragment_retries": 10,
+        "socket_timeout": 20,
+    },
+    "youtube": {"concurrent_fragment_downloads": 8},
+    "instagram": {"concurrent_fragment_downloads": 8, "http_chunk_size": None},
+}
+EXTERNAL_DOWNLOADER = None  # masalan "aria2c" — o'rnatilgan bo'lsa ko'p ulanishli yuklash
+EXTERNAL_DOWNLOADER_ARGS = {"aria2c": ["-x", "8", "-s", "8", "-k", "1M", "--summary-interval=1"]}
+download_timings = deque(maxlen=500)  # recent jobs: {"extractor", "seconds", "bytes", "time"}
+
+def url_extractor(url: str) -> str:
+    return canonical_url(url).split(":", 1)[0]
+
+def engine_opts(url: str) -> dict:
+    """yt-dlp options of the engine profile for this URL's extractor."""
+    opts = dict(ENGINE_PROFILES["default"])
+    opts.update(ENGINE_PROFILES.get(url_extractor(url), {}))
+    opts = {k: v for k, v in opts.items() if v is not None}
+    if EXTERNAL_DOWNLOADER and shutil.which(EXTERNAL_DOWNLOADER):
+        # plain http(s) only; fragment protocols stay on the native concurrent downloader
+        opts["external_downloader"] = {"http": EXTERNAL_DOWNLOADER}
+        opts["external_downloader_args"] = {EXTERNAL_DOWNLOADER: EXTERNAL_DOWNLOADER_ARGS.get(EXTERNAL_DOWNLOADER, [])}
+    return opts
 
 # ----------------- DOWNLOAD HELPERS -----------------
 def ytdl_extract_info(url, ydl_opts):
@@ -219,21 +1543,853 @@ def ytdl_extract_info(url, ydl_opts):
         info = ydl.extract_info(url, download=False)
         return info
 
-# ----------------- ADMIN MANAGEMENT (admins.json) -----------------
-def save_admins():
-    save_json(ADMINS_FILE, admins)
+def ytdl_download(url, ydl_opts, info=None):
+    # runs inside the scheduler pool, never on the event loop
+    started = time.monotonic()
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if info is None:
+            info = ydl.extract_info(url, download=True)
+        else:
+            # reuse the metadata pass instead of resolving the URL again
+            try:
+                info = ydl.process_ie_result(ydl.sanitize_info(info, True), download=True)
+            except yt_dlp.utils.DownloadError:
+                # stream URLs in the cached info expired — resolve afresh
+                info = ydl.extract_info(url, download=True)
+        return info, ydl.prepare_filename(info), time.monotonic() - started
+
+async def run_blocking(fn, *args):
+    """Run a short blocking call (metadata, HTTP, file moves) on the default executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, fn, *args)
+
+info_cache = TTLCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)  # canonical url -> slim info dict
+
+# what the bot reads plus what process_ie_result needs to download from the dict again
+INFO_KEYS = (
+    "id", "title", "fulltitle", "display_id", "ext", "duration", "formats", "http_headers",
+    "tags", "description", "channel", "uploader", "track", "artist", "acodec",
+    "extractor", "extractor_key", "webpage_url", "webpage_url_basename", "webpage_url_domain",
+    "original_url", "_type", "is_live", "live_status", "was_live", "age_limit", "availability",
+)
+# single-format results (no "formats" list) carry the format itself at the top level
+FORMAT_KEYS = (
+    "url", "format_id", "protocol", "vcodec", "width", "height", "tbr", "abr", "filesize",
+    "filesize_approx", "manifest_url", "fragments", "fragment_base_url", "downloader_options",
+)
+
+def slim_info(info: dict) -> dict:
+    """Drop captions, thumbnails, heatmaps and storyboards: most of an info dict's memory.
+
+    info_cache and pending_requests hold thousands of these for minutes.
+    """
+    slim = {k: info[k] for k in INFO_KEYS if k in info}
+    if "formats" in slim:
+        slim["formats"] = [f for f in slim["formats"] if f.get("ext") != "mhtml"]
+    else:
+        slim.update((k, info[k]) for k in FORMAT_KEYS if k in info)
+    return slim
+
+async def get_info(url: str) -> dict:
+    """extract_info(download=False), resolved at most once per TTL per media."""
+    key = canonical_url(url)
+    info = info_cache.get(key)
+    if info is None:
+        with perf.timer("metadata", url_extractor(url)):
+            info = slim_info(await run_blocking(ytdl_extract_info, url, {'quiet': True}))
+        info_cache.set(key, info)
+    return info
+
+# ----------------- JOB WORKSPACES -----------------
+def workspace_name(key: str) -> str:
+    # stable per media+format, so a restarted job finds its .part files again
+    return "job_" + uuid.uuid5(uuid.NAMESPACE_URL, key).hex[:16]
+
+@asynccontextmanager
+async def job_workspace(name=None):
+    """Private scratch dir for one download; removed with all fragments on exit.
+
+    A named workspace survives cancellation (shutdown) so the job can resume.
+    """
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    if name:
+        path = os.path.join(SCRATCH_DIR, name)
+        os.makedirs(path, exist_ok=True)
+    else:
+        path = tempfile.mkdtemp(prefix="job_", dir=SCRATCH_DIR)
+    keep = False
+    try:
+        yield path
+    except (asyncio.CancelledError, yt_dlp.utils.DownloadCancelled):
+        keep = bool(name)
+        raise
+    finally:
+        if not keep:
+            # SCRATCH_DIR may hold a multi-GB tree; don't walk it on the loop
+            await run_blocking(shutil.rmtree, path, True)
+
+def keep_media(path: str) -> str:
+    """Move a finished file out of its workspace into MEDIA_DIR under a unique name."""
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(path))
+    dest = os.path.join(MEDIA_DIR, f"{base}_{uuid.uuid4().hex[:8]}{ext}")
+    shutil.move(path, dest)
+    return dest
+
+def clean_scratch():
+    # workspaces left behind by a crash or kill, except those of jobs we will resume
+    if not os.path.isdir(SCRATCH_DIR):
+        return
+    resumable = {workspace_name(j["key"]) for j in jobs.values()}
+    for name in os.listdir(SCRATCH_DIR):
+        if name.startswith("job_") and name not in resumable:
+            shutil.rmtree(os.path.join(SCRATCH_DIR, name), ignore_errors=True)
+
+# ----------------- SINGLE-FLIGHT -----------------
+class FlightJob:
+    """One running download shared by every identical request."""
+
+    def __init__(self, key: str, msg):
+        self.key = key
+        self.messages = [msg]  # status messages of all attached requests
+        self.reporter = ProgressReporter(self.messages, PROGRESS_INTERVAL)
+        self.future = asyncio.get_running_loop().create_future()
+
+inflight_jobs = {}  # cache_key -> FlightJob
+
+async def single_flight(key: str, msg, work, admit=None):
+    """Run work(job) once per key and return (leader, outcome).
+
+    Requests for the same key made while it runs attach their status message
+    to the job (so they see its progress) and get the same outcome. admit()
+    runs before this request would lead a new job and may raise to refuse it.
+    If the leader is refused a download slot, a waiting request takes over.
+    """
+    joined = False
+    while key in inflight_jobs:
+        job = inflight_jobs[key]
+        job.messages.append(msg)
+        if not joined:
+            joined = True
+            try:
+                await msg.edit_text("🔗 Bu fayl hozir yuklanmoqda — tayyor bo'lishi bilan yuboriladi.")
+            except:
+                pass
+        outcome = await asyncio.shield(job.future)
+        if outcome[0] != "retry":
+            return False, outcome
+    if admit:
+        admit()
+    job = FlightJob(key, msg)
+    inflight_jobs[key] = job
+    outcome = ("error", "Yuklash to'xtatildi")
+    try:
+        outcome = await work(job)
+        return True, outcome
+    except UserJobLimit:
+        # only the leader's user is over the limit; the others can still have it
+        outcome = ("retry", None)
+        raise
+    except Exception as e:
+        outcome = ("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        job.reporter.close()
+        inflight_jobs.pop(key, None)
+        job.future.set_result(outcome)
+
+# ----------------- FULL SONG SEARCH -----------------
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)  # normalized query -> ranked video ids
+
+def normalize_query(text: str) -> str:
+    # drop "(Official Video)", "[4K]", hashtags and punctuation; keep non-latin letters
+    text = re.sub(r"\(.*?\)|\[.*?\]|#\w+", " ", (text or "").lower())
+    text = re.sub(r"[^\w ]+", " ", text)
+    return " ".join(text.split())
+
+def ytsearch(query: str, count: int):
+    opts = {'quiet': True, 'extract_flat': 'in_playlist', 'socket_timeout': 10}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        result = ydl.extract_info(f"ytsearch{count}:{query}", download=False)
+    return [e for e in result.get("entries") or [] if e and e.get("id")]
+
+def rank_results(entries, query: str, source: dict):
+    """Order search hits by how likely they are the full studio track of `source`."""
+    words = set(query.split())
+    source_channel = (source.get("channel") or source.get("uploader") or "").lower()
+
+    def score(e):
+        title = (e.get("title") or "").lower()
+        channel = (e.get("channel") or e.get("uploader") or "").lower()
+        s = 3 * len(words & set(normalize_query(title).split())) / max(1, len(words))
+        if "official audio" in title:
+            s += 3
+        elif "audio" in title or "lyric" in title:
+            s += 1
+        if channel.endswith(" - topic") or "vevo" in channel:
+            s += 2
+        if source_channel and source_channel in channel:
+            s += 1
+        for word in ("live", "remix", "cover", "sped up", "slowed"):
+            if word in title and word not in query:
+                s -= 1
+        duration = e.get("duration")
+        if duration:
+            if duration < 60 or duration > 15 * 60:  # shorts / mixes
+                s -= 4
+            elif 120 <= duration <= 480:
+                s += 1
+        return s
+
+    return sorted((e for e in entries if e["id"] != source.get("id")), key=score, reverse=True)
+
+async def find_full_song(info: dict):
+    """Video id of the best full-length match for `info`, or None."""
+    if info.get("track"):
+        query = normalize_query(f"{info.get('artist') or ''} {info['track']}")
+    else:
+        query = normalize_query(info.get("title", ""))
+    if not query:
+        return None
+    ids = search_cache.get(query)
+    if ids is None:
+        entries = await asyncio.wait_for(
+            run_blocking(ytsearch, f"{query} official audio", SEARCH_RESULTS), SEARCH_TIMEOUT)
+        ids = [e["id"] for e in rank_results(entries, query, info)]
+        search_cache.set(query, ids)
+    return ids[0] if ids else None
+
+# ----------------- DOWNLOAD SCHEDULER -----------------
+class UserJobLimit(Exception):
+    """User already has DOWNLOAD_PER_USER jobs queued or running."""
+
+class DownloadScheduler:
+    """Job queue drained by a bounded thread/process pool.
+
+    Handlers enqueue blocking yt-dlp work and await the result, so the event
+    loop keeps serving other updates. At most `workers` jobs run at once and a
+    user may hold at most `per_user` queued or running jobs.
+    """
+
+    def __init__(self, workers: int, per_user: int, pool_kind: str = "thread"):
+        self.workers = workers
+        self.per_user = per_user
+        self.pool_kind = pool_kind
+        self.pool = None
+        self.queue = None
+        self.tasks = []
+        self.running = 0
+        self.inflight = {}  # user_id -> queued + running jobs
+
+    def start(self):
+        if self.queue is not None:
+            return
+        if self.pool_kind == "process":
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ytdl")
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, user_id: int, fn, *args):
+        """Enqueue fn(*args). Returns (position, future); position 0 means it starts now."""
+        self.start()
+        if self.inflight.get(user_id, 0) >= self.per_user:
+            raise UserJobLimit()
+        self.inflight[user_id] = self.inflight.get(user_id, 0) + 1
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((user_id, fn, args, fut))
+        idle = self.workers - self.running
+        return max(0, self.queue.qsize() - idle), fut
 
+    def _release(self, user_id: int):
+        left = self.inflight.get(user_id, 0) - 1
+        if left > 0:
+            self.inflight[user_id] = left
+        else:
+            self.inflight.pop(user_id, None)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            user_id, fn, args, fut = await self.queue.get()
+            self.running += 1
+            try:
+                if fut.cancelled():
+                    continue
+                result = await loop.run_in_executor(self.pool, fn, *args)
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self.running -= 1
+                self._release(user_id)
+                self.queue.task_done()
+
+scheduler = DownloadScheduler(DOWNLOAD_WORKERS, DOWNLOAD_PER_USER, DOWNLOAD_POOL)
+
+async def run_download(msg, user_id: int, url: str, ydl_opts: dict, info=None, variant="-"):
+    """Queue a yt-dlp download and wait for it; returns (info, filename)."""
+    queued = time.perf_counter()
+    ydl_opts = {**engine_opts(url), **ydl_opts}
+    if scheduler.pool_kind == "process":
+        # hooks close over the event loop and cannot cross a process boundary
+        ydl_opts = {k: v for k, v in ydl_opts.items() if k != "progress_hooks"}
+    else:
+        ydl_opts['progress_hooks'] = ydl_opts.get('progress_hooks', []) + [abort_hook]
+    position, fut = scheduler.submit(user_id, ytdl_download, url, ydl_opts, info)
+    if position:
+        try:
+            await msg.edit_text(f"⏳ Navbatdasiz: {position}-o'rin")
+        except:
+            pass
+    info, filename, seconds = await fut
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    extractor = url_extractor(url)
+    perf.observe("queue_wait", max(0.0, time.perf_counter() - queued - seconds), extractor, variant)
+    perf.observe("download", seconds, extractor, variant, size)
+    download_timings.append({"extractor": url_extractor(url), "seconds": round(seconds, 2),
+                             "bytes": size, "time": now_iso()})
+    return info, filename
+
+# ----------------- JOB RECORDS -----------------
+download_abort = threading.Event()  # set on shutdown once the drain deadline passes
+draining = False                    # no new downloads start while True
+active_jobs = set()                 # tasks running run_media_job
+
+def abort_hook(d):
+    # runs in the download thread; yt-dlp stops and leaves its .part file behind
+    if download_abort.is_set():
+        raise yt_dlp.utils.DownloadCancelled("bot to'xtatilmoqda")
+
+def job_record(uid: int, msg, url: str, kind: str, quality) -> str:
+    job_id = uuid.uuid4().hex[:12]
+    jobs[job_id] = {
+        "uid": uid, "chat": msg.chat.id, "msg": msg.id, "url": url,
+        "key": cache_key(url, media_variant(kind, quality)),
+        "kind": kind, "quality": quality, "state": "queued", "time": now_iso(),
+    }
+    store.put("jobs", job_id, jobs[job_id])
+    return job_id
+
+def job_state(job_id: str, state: str):
+    if job_id in jobs:
+        jobs[job_id]["state"] = state
+        store.put("jobs", job_id, jobs[job_id])
+
+def job_done(job_id: str):
+    if jobs.pop(job_id, None) is not None:
+        store.delete("jobs", job_id)
+
+async def park_job(job_id: str, msg):
+    # shutdown deadline: keep the record (and .part files) for the next start
+    job_state(job_id, "interrupted")
+    try:
+        await msg.edit_text("⏸ Bot qayta ishga tushmoqda — yuklash keyin davom etadi.")
+    except:
+        pass
+
+async def resume_jobs(client):
+    """Re-run downloads cut off by a restart; identical ones share one flight again."""
+    for job_id, rec in list(jobs.items()):
+        try:
+            msg = await client.get_messages(rec["chat"], rec["msg"])
+        except Exception:
+            msg = None
+        if msg is None or msg.empty:
+            job_done(job_id)
+            continue
+        job_state(job_id, "resumed")
+        asyncio.create_task(run_media_job(rec["uid"], msg, rec["url"], rec["kind"], rec["quality"], job_id=job_id))
+
+async def drain_jobs(timeout: float):
+    """Stop taking downloads, let running ones finish, park the rest for the next start."""
+    global draining
+    draining = True
+    pending = [t for t in active_jobs if not t.done()]
+    if pending:
+        print(f"{len(pending)} ta yuklash tugashi kutilmoqda ({timeout}s)...")
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+    if pending:
+        download_abort.set()
+        worker_pool.stop_downloads()
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=10)
+
+# ----------------- WORKER PROCESSES -----------------
+PROGRESS_KEYS = ("status", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "speed", "eta")
+
+class WorkerPool:
+    """SCALE_WORKERS child processes that download, convert and upload for the dispatcher.
+
+    The dispatcher (this process, the only one receiving updates) keeps every
+    piece of state: bans, rate limits, the cache index and file_ids stay
+    single-writer here and in SQLite, so all workers share one consistent view
+    and one cache. Uploads wait for a slot from the dispatcher's api_limiter and
+    report FloodWait back to it, so the API budget stays bot-wide too. Workers are stateless: a job goes out as a dict to the least
+    busy worker, progress and the outcome come back over a shared queue.
+    """
+
+    def __init__(self, size: int, jobs_per_worker: int, per_user: int):
+        self.size = size
+        self.jobs_per_worker = jobs_per_worker
+        self.per_user = per_user
+        self.ctx = multiprocessing.get_context("spawn")  # children must not inherit the loop / db handle
+        self.procs = []
+        self.queues = []    # one job queue per worker: a killed reader can't wedge the others
+        self.load = []      # jobs handed to each worker and not finished yet
+        self.events_q = self.abort = None
+        self.waiting = {}   # job id -> (future, progress hook, worker number)
+        self.inflight = {}  # user_id -> jobs out at workers
+        self.grants = set() # tasks waiting on api_limiter for a worker's upload
+        self.loop = None
+
+    def start(self):
+        if not self.size or self.procs:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.events_q, self.abort = self.ctx.Queue(), self.ctx.Event()
+        self.queues = [self.ctx.Queue() for _ in range(self.size)]
+        self.load = [0] * self.size
+        self.procs = [self._spawn(n) for n in range(self.size)]
+        threading.Thread(target=self._read_events, name="worker-events", daemon=True).start()
+
+    def _spawn(self, n: int):
+        p = self.ctx.Process(target=worker_main, name=f"worker{n}", daemon=True,
+                             args=(n, self.queues[n], self.events_q, self.abort, self.jobs_per_worker))
+        p.start()
+        return p
+
+    def _read_events(self):
+        check_at = time.monotonic() + 1
+        while True:
+            try:
+                item = self.events_q.get(timeout=1)
+            except Empty:
+                item = ()
+            if item is None:
+                return
+            try:
+                if item:
+                    self.loop.call_soon_threadsafe(self._event, *item)
+                # progress keeps the queue busy, so liveness runs on its own clock
+                if time.monotonic() >= check_at:
+                    check_at = time.monotonic() + 1
+                    self.loop.call_soon_threadsafe(self._check_workers)
+            except RuntimeError:
+                return  # loop closed
+
+    def _event(self, kind, job_id, payload):
+        fut, hook, _ = self.waiting.get(job_id, (None, None, None))
+        if fut is None:
+            return
+        if kind == "progress":
+            hook(payload)
+        elif kind == "acquire":
+            # workers upload with this process's budget: one global and per-chat limit for the bot
+            task = asyncio.create_task(self._grant(job_id, payload))
+            self.grants.add(task)
+            task.add_done_callback(self.grants.discard)
+        elif kind == "flood":
+            api_limiter.pause(*payload)
+        elif not fut.done():
+            fut.set_result(payload)
+
+    async def _grant(self, job_id, chat_id):
+        await api_limiter.acquire(chat_id, PRIO_HIGH)
+        entry = self.waiting.get(job_id)
+        if entry is not None:
+            self.queues[entry[2]].put(("grant", job_id))
+
+    def _check_workers(self):
+        # a crashed worker takes its jobs with it: fail them and start a new one
+        for n, p in enumerate(self.procs):
+            if p.is_alive():
+                continue
+            print(f"worker{n} exited ({p.exitcode}), restarting")
+            for fut, _, owner in list(self.waiting.values()):
+                if owner == n and not fut.done():
+                    fut.set_result(("error", f"worker{n} to'xtab qoldi"))
+            if not self.abort.is_set():
+                self.queues[n] = self.ctx.Queue()
+                self.procs[n] = self._spawn(n)
+
+    async def run(self, user_id: int, job: dict, hook):
+        """Hand `job` to the least busy worker and wait for its (status, data)."""
+        if self.inflight.get(user_id, 0) >= self.per_user:
+            raise UserJobLimit()
+        self.inflight[user_id] = self.inflight.get(user_id, 0) + 1
+        n = min(range(self.size), key=self.load.__getitem__)
+        self.load[n] += 1
+        job["id"] = uuid.uuid4().hex
+        job["queued"] = time.time()
+        fut = self.loop.create_future()
+        self.waiting[job["id"]] = (fut, hook, n)
+        try:
+            self.queues[n].put(job)
+            return await fut
+        finally:
+            self.waiting.pop(job["id"], None)
+            self.load[n] -= 1
+            left = self.inflight.get(user_id, 0) - 1
+            if left > 0:
+                self.inflight[user_id] = left
+            else:
+                self.inflight.pop(user_id, None)
+
+    def stop_downloads(self):
+        if self.abort is not None:
+            self.abort.set()
+
+    def stop(self, timeout: float = 10):
+        if not self.procs:
+            return
+        self.abort.set()  # no restarts from here on
+        for q in self.queues:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for p in self.procs:
+            p.join(max(0.0, deadline - time.monotonic()))
+            if p.is_alive():
+                p.terminate()
+        self.events_q.put(None)
+        self.procs = []
+
+worker_pool = WorkerPool(SCALE_WORKERS, SCALE_WORKER_JOBS, DOWNLOAD_PER_USER)
+
+def worker_main(n, jobs_q, events_q, abort, concurrency):
+    """Entry point of a worker process."""
+    global download_abort
+    download_abort = abort  # abort_hook now follows the dispatcher's shutdown
+    # the dyno's SIGTERM reaches every process; the dispatcher drains and then stops us
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_loop(n, jobs_q, events_q, concurrency))
+
+async def worker_loop(n, jobs_q, events_q, concurrency):
+    # uploads only: updates keep going to the dispatcher
+    client = Client(f"{APP_NAME}_worker{n}", api_id=config.API_ID, api_hash=config.API_HASH,
+                    bot_token=config.BOT_TOKEN, no_updates=True)
+    await client.start()
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    grants = {}  # job id -> future set when the dispatcher grants an upload slot
+    tasks = set()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, jobs_q.get)
+            if item is None:
+                break
+            if isinstance(item, tuple):  # ("grant", job id)
+                fut = grants.pop(item[1], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
+                continue
+            task = asyncio.create_task(worker_job(client, item, events_q, slots, grants))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await client.stop()
+
+async def worker_job(client, job, events_q, slots, grants):
+    job_id, url, kind = job["id"], job["url"], job["kind"]
+    timings = {}
+    last = [0.0]
+
+    def progress(d):
+        # yt-dlp calls this per chunk; the dispatcher only needs a sample every now and then
+        now = time.monotonic()
+        if d.get("status") == "downloading" and now - last[0] >= 0.5:
+            last[0] = now
+            events_q.put(("progress", job_id, {k: d.get(k) for k in PROGRESS_KEYS}))
+
+    async def download(opts, info):
+        opts = {**engine_opts(url), **opts}
+        opts['progress_hooks'] = opts['progress_hooks'] + [abort_hook]
+        info, filename, seconds = await run_blocking(ytdl_download, url, opts, info)
+        timings["download"] = seconds
+        timings["bytes"] = os.path.getsize(filename) if os.path.exists(filename) else 0
+        return info, filename
+
+    async def send(path):
+        send_fn = client.send_audio if kind == "audio" else client.send_video
+        for attempt in range(API_RETRIES + 1):
+            grants[job_id] = asyncio.get_running_loop().create_future()
+            events_q.put(("acquire", job_id, job["chat"]))
+            await grants[job_id]
+            try:
+                return await send_fn(job["chat"], path, caption=job["title"])
+            except FloodWait as e:
+                events_q.put(("flood", job_id, (job["chat"], e.value)))
+                if attempt == API_RETRIES:
+                    raise
+
+    try:
+        async with slots:
+            timings["queue_wait"] = max(0.0, time.time() - job["queued"])
+            status, data = await transfer(job["key"], url, kind, job["fmt"], job["info"], [progress], download, send)
+        if status == "ok":
+            data.update(timings)
+    except Exception as e:
+        status, data = "error", str(e)
+    events_q.put(("done", job_id, (status, data)))
+
+# ----------------- ADMIN MANAGEMENT (admins.json) -----------------
 def make_admin(target_user_id: int, level: int):
     admins[str(target_user_id)] = int(level)
-    save_admins()
+    store.put("admins", target_user_id, int(level))
     add_history(target_user_id, "promoted", f"level={level}")
 
 def unmake_admin(target_user_id: int):
     if str(target_user_id) in admins:
         del admins[str(target_user_id)]
-        save_admins()
+        store.delete("admins", target_user_id)
         add_history(target_user_id, "demoted", "")
 
+# ----------------- RATE LIMITING -----------------
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, at most `burst` saved up."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        if time.monotonic() < self.paused_until:
+            return False
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # FloodWait: nobody sharing this bucket sends until it is over
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# ----------------- OUTGOING API LIMITER -----------------
+# priority classes for outgoing calls (lower goes first)
+PRIO_HIGH = 0    # final media, command replies
+PRIO_NORMAL = 1  # status edits
+PRIO_LOW = 2     # progress edits: dropped when over budget
+PRIO_BULK = 3    # broadcast
+api_priority = contextvars.ContextVar("api_priority", default=None)
+
+class ApiLimiter:
+    """Global + per-chat token buckets in front of the client's send/edit calls.
+
+    Calls that cannot go out at once wait in a priority heap, so replies and
+    media are never stuck behind progress edits or a broadcast. PRIO_LOW calls
+    are dropped instead of queued (the next progress sample replaces them).
+    FloodWait pauses the global and the chat's bucket and the call is retried
+    (broadcast calls get the error back).
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, retries: int):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.chats = TTLCache(20000, 60)  # chat_id -> TokenBucket; an idle bucket is full anyway
+        self.heap = []
+        self.seq = 0
+        self.dispatcher = None
+        self.counters = {"calls": 0, "throttled": 0, "dropped": 0, "flood_waits": 0}
+
+    def _chat(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self.chats.set(chat_id, bucket)
+        return bucket
+
+    async def acquire(self, chat_id, priority: int) -> bool:
+        """Wait for a slot; False means the (low priority) call should be dropped."""
+        self.counters["calls"] += 1
+        chat = self._chat(chat_id)
+        if priority >= PRIO_LOW and priority != PRIO_BULK:
+            if self.heap or not chat.try_acquire() or not self.bucket.try_acquire():
+                self.counters["dropped"] += 1
+                return False
+            return True
+        if not chat.try_acquire():
+            self.counters["throttled"] += 1
+            await chat.acquire()
+        if not self.heap and self.bucket.try_acquire():
+            return True
+        self.counters["throttled"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.heap, (priority, self.seq, fut))
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        await fut
+        return True
+
+    async def _dispatch(self):
+        try:
+            while self.heap:
+                await self.bucket.acquire()
+                while self.heap:
+                    fut = heapq.heappop(self.heap)[2]
+                    if not fut.done():
+                        fut.set_result(True)
+                        break
+        finally:
+            self.dispatcher = None
+
+    def pause(self, chat_id, seconds: float):
+        self.counters["flood_waits"] += 1
+        # the flood limit is bot-wide: nothing goes out until it is over
+        self.bucket.pause(seconds)
+        self._chat(chat_id).pause(seconds)
+
+    def wrap(self, fn, default_priority: int):
+        async def call(*args, **kwargs):
+            chat_id = kwargs.get("chat_id", args[0] if args else None)
+            priority = api_priority.get()
+            if priority is None:
+                priority = default_priority
+            for attempt in range(self.retries + 1):
+                if not await self.acquire(chat_id, priority):
+                    return None
+                try:
+                    return await fn(*args, **kwargs)
+                except FloodWait as e:
+                    self.pause(chat_id, e.value)
+                    # a broadcast backs off on its own bucket
+                    if priority in (PRIO_LOW, PRIO_BULK) or attempt == self.retries:
+                        raise
+        return call
+
+api_limiter = ApiLimiter(API_RATE, API_CHAT_RATE, API_CHAT_BURST, API_RETRIES)
+for _name, _prio in (("send_message", PRIO_HIGH), ("send_audio", PRIO_HIGH), ("send_video", PRIO_HIGH),
+                     ("send_document", PRIO_HIGH), ("edit_message_text", PRIO_NORMAL)):
+    setattr(app, _name, api_limiter.wrap(getattr(app, _name), _prio))
+
+# ----------------- BROADCAST -----------------
+# the recipient is gone for good; anything else (e.g. PeerIdInvalid) only counts as failed
+BLOCKED_ERRORS = (Forbidden, UserIsBlocked, InputUserDeactivated)
+broadcast_tasks = set()
+
+def broadcast_status(state: dict, done: bool = False) -> str:
+    head = "✅ Broadcast tugadi" if done else "📣 Broadcast davom etmoqda"
+    sent = state["success"] + state["failed"] + state["blocked"]
+    return (f"{head}: {sent}/{state['total']}\n"
+            f"✅ Yuborildi: {state['success']}\n"
+            f"❌ Muvaffaqiyatsiz: {state['failed']}\n"
+            f"🚫 Bloklagan (o'chirildi): {state['blocked']}")
+
+def prune_user(uid: str):
+    if users.pop(uid, None) is not None:
+        store.delete("users", uid)
+
+async def broadcast_send(client, chat_id: int, text: str, bucket: TokenBucket) -> str:
+    for _ in range(BROADCAST_RETRIES):
+        await bucket.acquire()
+        try:
+            await client.send_message(chat_id, text)
+            return "success"
+        except FloodWait as e:
+            bucket.pause(e.value)
+        except BLOCKED_ERRORS:
+            return "blocked"
+        except Exception:
+            return "failed"
+    return "failed"
+
+async def run_broadcast(client, state: dict):
+    """Send state["text"] to every user with id above state["cursor"].
+
+    Recipients go out in id order through BROADCAST_CONCURRENCY senders that
+    share one token bucket. The cursor only moves past ids whose send has
+    finished and is persisted with the counters, so a restart resumes there.
+    """
+    recipients = sorted(int(u) for u in users if int(u) > state["cursor"])
+    finished = bytearray(len(recipients))
+    mark = 0  # recipients[:mark] are all finished
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+    todo = iter(enumerate(recipients))
+
+    async def sender():
+        nonlocal mark
+        api_priority.set(PRIO_BULK)
+        for i, chat_id in todo:
+            result = await broadcast_send(client, chat_id, state["text"], bucket)
+            state[result] += 1
+            if result == "blocked":
+                prune_user(str(chat_id))
+            finished[i] = 1
+            while mark < len(recipients) and finished[mark]:
+                mark += 1
+            if mark:
+                state["cursor"] = recipients[mark - 1]
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_REPORT_EVERY)
+            store.put("broadcasts", "current", state)
+            try:
+                await client.edit_message_text(state["admin"], state["status"], broadcast_status(state))
+            except:
+                pass
+
+    report = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(sender() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        report.cancel()
+        store.put("broadcasts", "current", state)
+    broadcasts.pop("current", None)
+    store.delete("broadcasts", "current")
+    try:
+        await client.edit_message_text(state["admin"], state["status"], broadcast_status(state, done=True))
+    except:
+        await client.send_message(state["admin"], broadcast_status(state, done=True))
+
+def start_broadcast(client, state: dict):
+    broadcasts["current"] = state
+    store.put("broadcasts", "current", state)
+    task = asyncio.create_task(run_broadcast(client, state))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+async def resume_broadcast(client):
+    state = broadcasts.get("current")
+    if not state:
+        return
+    try:
+        msg = await client.send_message(state["admin"], "📣 Broadcast qayta ishga tushdi, davom ettirilmoqda...")
+        state["status"] = msg.id
+    except:
+        pass
+    start_broadcast(client, state)
+
 # ----------------- HANDLERS: ADMIN COMMANDS (must be BEFORE text handler) -----------------
 # /makeadmin @username level
 @app.on_message(filters.command("makeadmin") & filters.private)
@@ -358,21 +2514,19 @@ async def cmd_ban(client, message):
         username = parts[1]; duration = parts[2]; reason = parts[3] if len(parts)>3 else "Sababsiz"
         user = await client.get_users(username)
         if duration == "permanent":
-            ban_user(user.id, 0, reason)
+            ban_user(user.id, None, reason)
         else:
             # parse 1d or 5h
             if duration.endswith("d"):
-                n = int(duration[:-1])
-                ban_user(user.id, n, reason)
+                days = int(duration[:-1])
             elif duration.endswith("h"):
-                # convert hours to days fraction not supported -> store iso until
-                hours = int(duration[:-1])
-                until = (datetime.now() + timedelta(hours=hours)).isoformat()
-                banned_users[str(user.id)] = {"until": until, "reason": reason}
-                save_json(BANNED_FILE, banned_users)
+                days = int(duration[:-1]) / 24
             else:
+                days = 0
+            if days <= 0:
                 await message.reply("❗ Vaqt formati xato. Misol: 1d yoki 5h yoki permanent")
                 return
+            ban_user(user.id, days, reason)
         await message.reply(f"✅ @{user.username} banlandi. Sabab: {reason}")
         add_history(user.id, "ban_manual", reason)
     except Exception as e:
@@ -391,9 +2545,7 @@ async def cmd_unban(client, message):
             return
         username = parts[1]; reason = parts[2] if len(parts)>2 else "Sababsiz"
         user = await client.get_users(username)
-        if str(user.id) in banned_users:
-            del banned_users[str(user.id)]
-            save_json(BANNED_FILE, banned_users)
+        if unban_user(user.id):
             add_history(user.id, "unban_manual", reason)
             await message.reply(f"✅ @{user.username} bandan chiqarildi.")
         else:
@@ -413,6 +2565,8 @@ async def cmd_stats(client, message):
     downloads = stats.get("downloads", 0)
     audio = stats.get("audio", 0)
     video = stats.get("video", 0)
+    moved = sum(t["bytes"] for t in download_timings)
+    spent = sum(t["seconds"] for t in download_timings) or 1
     text = (
         f"📊 Statistika:\n"
         f"- Yuklashlar: {downloads}\n"
@@ -420,9 +2574,48 @@ async def cmd_stats(client, message):
         f"- Banlanganlar: {total_banned}\n"
         f"- Jami warnlar: {total_warns}\n"
         f"- Adminlar: {total_admins}\n"
+        f"- So'nggi {len(download_timings)} yuklash: {moved / spent / (1024 * 1024):.1f} MB/s o'rtacha\n"
+        f"- API: {api_limiter.counters['calls']} so'rov, {api_limiter.counters['throttled']} kutildi, "
+        f"{api_limiter.counters['dropped']} tashlandi, {api_limiter.counters['flood_waits']} FloodWait\n"
     )
     await message.reply(text)
 
+# /perf [5m|1h|24h] (admins >=2)
+@app.on_message(filters.command("perf") & filters.private)
+async def cmd_perf(client, message):
+    if admin_level(message.from_user.id) < 2:
+        await message.reply("⛔ Ruxsat yo'q.")
+        return
+    parts = message.text.split()
+    window = parts[1] if len(parts) > 1 else "1h"
+    if window not in PERF_WINDOWS:
+        await message.reply("❗ Foydalanish: /perf [5m|1h|24h]")
+        return
+    recent = perf.recent(PERF_WINDOWS[window])
+    by_stage = {}
+    for (stage, _, _), values in recent.items():
+        by_stage.setdefault(stage, []).extend(values)
+    text = f"📈 Perf (so'nggi {window}), sekund: p50 / p95 / p99\n"
+    for stage in ("metadata", "queue_wait", "download", "ffmpeg", "upload", "cached_send", "total", "joined", "search"):
+        values = [v for v, _ in by_stage.get(stage, [])]
+        if values:
+            text += (f"- {stage}: {percentile(values, 50):.2f} / {percentile(values, 95):.2f} / "
+                     f"{percentile(values, 99):.2f}  (n={len(values)})\n")
+    hits = sum(v for (n, _, _), v in perf.counters.items() if n == "cache_hit")
+    misses = sum(v for (n, _, _), v in perf.counters.items() if n == "cache_miss")
+    if hits + misses:
+        text += f"- Kesh (jami): {hits} hit / {misses} miss ({hits * 100 // (hits + misses)}%)\n"
+    downloads = sorted((k, v) for k, v in recent.items() if k[0] == "download")
+    if downloads:
+        text += "\n⬇️ Yuklash (extractor / sifat):\n"
+    for (_, extractor, quality), values in downloads:
+        seconds = [v for v, _ in values]
+        moved = sum(b for _, b in values)
+        speed = moved / (sum(seconds) or 1) / (1024 * 1024)
+        text += (f"- {extractor} {quality}: p50 {percentile(seconds, 50):.1f}s, p95 {percentile(seconds, 95):.1f}s, "
+                 f"{human_size(moved)}, {speed:.1f} MB/s (n={len(values)})\n")
+    await message.reply(text)
+
 # /history @username (admin>=2)
 @app.on_message(filters.command("history") & filters.private)
 async def cmd_history(client, message):
@@ -432,16 +2625,27 @@ async def cmd_history(client, message):
     try:
         parts = message.text.split()
         if len(parts) < 2:
-            await message.reply("❗ Foydalanish: /history @username")
+            await message.reply("❗ Foydalanish: /history @username [sahifa] [event=ban] [from=2025-10-01] [to=2025-10-31]")
             return
         username = parts[1]
+        page, event, since, until = 1, None, None, None
+        for token in parts[2:]:
+            if token.isdigit():
+                page = max(1, int(token))
+            elif token.startswith("event="):
+                event = token[6:]
+            elif token.startswith("from="):
+                since = iso_epoch(token[5:])
+            elif token.startswith("to="):
+                until = iso_epoch(token[3:]) + 86400  # include the whole day
         user = await client.get_users(username)
-        entries = history.get(str(user.id), [])
+        entries, total = history_log.query(user.id, event, since, until, page, HISTORY_PAGE_SIZE)
         if not entries:
             await message.reply("ℹ️ Tarix topilmadi.")
             return
-        text = f"📜 @{user.username} tarixi:\n"
-        for e in entries[-30:]:
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        text = f"📜 @{user.username} tarixi ({page}/{pages}, jami {total}):\n"
+        for e in entries:
             text += f"- {e['time']}: {e['event']} ({e.get('note','')})\n"
         await message.reply(text)
     except Exception as e:
@@ -459,19 +2663,15 @@ async def cmd_sendall(client, message):
             await message.reply("❗ Foydalanish: /sendall message_text")
             return
         body = text[1]
-        await message.reply("📣 Broadcast boshlanmoqda...")
-
-        # Foydalanuvchilarni users.json dan oling
-        recipients = list(users.keys())
-        success = 0
-        failed = 0
-        for uid in recipients:
-            try:
-                await client.send_message(int(uid), body)
-                success += 1
-            except:
-                failed += 1
-        await message.reply(f"✅ Yuborildi: {success}\n❌ Muvaffaqiyatsiz: {failed}")
+        if "current" in broadcasts:
+            await message.reply("⏳ Oldingi broadcast hali tugamagan.")
+            return
+        status = await message.reply("📣 Broadcast boshlanmoqda...")
+        # runs in the background; progress is edited into `status`
+        start_broadcast(client, {
+            "text": body, "admin": message.chat.id, "status": status.id, "cursor": 0,
+            "total": len(users), "success": 0, "failed": 0, "blocked": 0, "started": now_iso(),
+        })
     except Exception as e:
         await message.reply(f"⚠️ Xatolik: {e}")
 
@@ -492,7 +2692,7 @@ async def cmd_start(client, message):
             "last_name": message.from_user.last_name or "",
             "added": now_iso()
         }
-        save_users(users)
+        save_users(users, uid)
 
     await message.reply(
         "🎬 Salom! YouTube/Instagram URL yuboring.\n"
@@ -518,15 +2718,16 @@ async def handler_text(client, message):
         await message.reply("❌ Iltimos, to'g'ri URL yuboring.")
         return
     url = text
-    user_links[user_id] = url
-    # update stats users map to know where to broadcast
+    token = new_request(user_id, url)
+    # update stats users map to know where to broadcast (only once per user)
     stats.setdefault("users", {})
-    stats["users"].setdefault(str(user_id), 0)
-    save_json(STATS_FILE, stats)
+    if str(user_id) not in stats["users"]:
+        stats["users"][str(user_id)] = 0
+        store.put("user_stats", user_id, 0)
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🎥 Video", callback_data="video")],
-        [InlineKeyboardButton("🎵 Musiqa", callback_data="audio")],
-        [InlineKeyboardButton("🎶 To'liq musiqa", callback_data="full_song")]
+        [InlineKeyboardButton("🎥 Video", callback_data=f"video:{token}")],
+        [InlineKeyboardButton("🎵 Musiqa", callback_data=f"audio:{token}")],
+        [InlineKeyboardButton("🎶 To'liq musiqa", callback_data=f"full_song:{token}")]
     ])
     await message.reply("⬇️ Formatni tanlang:", reply_markup=keyboard)
 
@@ -534,168 +2735,294 @@ async def handler_text(client, message):
 @app.on_callback_query()
 async def callback_handler(client, callback_query: CallbackQuery):
     uid = callback_query.from_user.id
+    # metered first, so even a banned user's presses are rate limited
+    if callback_throttled(uid):
+        await callback_query.answer("⏳ Juda tez bosyapsiz, biroz kuting.", show_alert=True)
+        return
     if is_user_banned(uid):
-        await callback_query.message.edit_text("🚫 Siz hozircha banlangansiz.")
+        # an answer is cheaper than editing the message on every press
+        await callback_query.answer("🚫 Siz hozircha banlangansiz.", show_alert=True)
         return
-    url = user_links.get(uid)
-    if not url:
-        await callback_query.message.edit_text("⛔ Avval URL yuboring.")
+    action, req = get_request(uid, callback_query.data)
+    if req is None:
+        await callback_query.message.edit_text("⛔ So'rov eskirgan, URL ni qayta yuboring.")
         return
-    action = callback_query.data
-    # Check cache
-    c = cache_get(url)
-    if c and os.path.exists(c.get("file","")):
-        # reuse
-        if action == "audio" and c["type"] in ("audio","both"):
-            await callback_query.message.edit_text("♻️ Oldingi audio topildi — yuborilmoqda...")
-            await callback_query.message.reply_audio(c["file"], caption=c.get("title","Audio (cache)"))
-            incr_stat(uid, "audio")
-            add_history(uid, "download_cached", url)
-            return
-        if action == "video" and c["type"] in ("video","both"):
-            await callback_query.message.edit_text("♻️ Oldingi video topildi — yuborilmoqda...")
-            await callback_query.message.reply_video(c["file"], caption=c.get("title","Video (cache)"))
-            incr_stat(uid, "video")
+    url, info, token = req["url"], req["info"], callback_query.data.partition(":")[2]
+    # Check cache (same media + same format/quality)
+    kind = quality = None
+    if action == "audio":
+        kind = "audio"
+    elif action.startswith("q_"):
+        kind, quality = "video", action.split("_",1)[1]
+    elif action == "video" and "youtu" not in url:
+        kind, quality = "video", "best"
+    if kind:
+        req["kind"], req["quality"] = kind, quality
+    key = cache_key(url, media_variant(kind, quality)) if kind else None
+    c = cache_get(url, media_variant(kind, quality)) if kind else None
+    if kind:
+        perf.incr("cache_hit" if cache_usable(c) else "cache_miss", 1, url_extractor(url), media_variant(kind, quality))
+    if cache_usable(c):
+        # reuse: by file_id when possible, no re-upload
+        await callback_query.message.edit_text(f"♻️ Oldingi {kind} topildi — yuborilmoqda...")
+        with perf.timer("cached_send", url_extractor(url), media_variant(kind, quality)):
+            delivered = await send_cached(callback_query.message, key, c, kind)
+        if delivered:
+            incr_stat(uid, kind)
             add_history(uid, "download_cached", url)
             return
     # else perform download
     if action == "audio":
-        await download_audio(callback_query, url)
+        await download_audio(callback_query, url, info)
     elif action == "video":
         # quality selection for youtube handled by subcallbacks q_*
         if "youtu" in url:
+            # estimated sizes on the buttons; ❌ marks qualities over MAX_FILE_SIZE
+            try:
+                info = req["info"] = info or await get_info(url)
+                label = lambda q: quality_label(info, q)
+            except Exception:
+                label = lambda q: "🔝 Eng yuqori" if q == "best" else f"{q}p"
             keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("360p", callback_data="q_360"),
-                 InlineKeyboardButton("720p", callback_data="q_720")],
-                [InlineKeyboardButton("1080p", callback_data="q_1080"),
-                 InlineKeyboardButton("🔝 Eng yuqori", callback_data="q_best")]
+                [InlineKeyboardButton(label("360"), callback_data=f"q_360:{token}"),
+                 InlineKeyboardButton(label("720"), callback_data=f"q_720:{token}")],
+                [InlineKeyboardButton(label("1080"), callback_data=f"q_1080:{token}"),
+                 InlineKeyboardButton(label("best"), callback_data=f"q_best:{token}")]
             ])
             await callback_query.message.edit_text("📺 Sifatni tanlang:", reply_markup=keyboard)
         else:
-            await download_video(callback_query, url, "best")
+            await download_video(callback_query, url, "best", info)
     elif action == "full_song":
-        await search_full_song(callback_query, url)
+        await search_full_song(callback_query, url, info)
     elif action.startswith("q_"):
         _, q = action.split("_",1)
-        await download_video(callback_query, url, q)
+        await download_video(callback_query, url, q, info)
 
 # DOWNLOAD FUNCTIONS
-async def download_audio(callback_query, url):
-    uid = callback_query.from_user.id
+async def download_audio(callback_query, url, info=None):
     msg = await callback_query.message.edit_text("🎧 Yuklanmoqda... 0%")
-    def hook(d): asyncio.create_task(progress_hook(d, msg))
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': 'audio.%(ext)s',
-        'quiet': True,
-        'nocheckcertificate': True,
-        'progress_hooks': [hook],
-        'postprocessors': [{'key': 'FFmpegExtractAudio','preferredcodec':'mp3','preferredquality':'192'}],
-    }
+    await run_media_job(callback_query.from_user.id, msg, url, "audio", None, info)
+
+async def download_video(callback_query, url, quality, info=None):
+    msg = await callback_query.message.edit_text(f"🎬 Video ({quality}) yuklanmoqda... 0%")
+    await run_media_job(callback_query.from_user.id, msg, url, "video", quality, info)
+
+def check_job_limit(user_id: int):
+    """Raise UserJobLimit if the user already has DOWNLOAD_PER_USER downloads out."""
+    pool = worker_pool if worker_pool.size else scheduler
+    if pool.inflight.get(user_id, 0) >= DOWNLOAD_PER_USER:
+        raise UserJobLimit()
+
+async def run_media_job(uid, msg, url, kind, quality, info=None, job_id=None):
+    """Download (or join an identical running download) and deliver it to this user.
+
+    The request is recorded until it finishes, so a restart can pick it up again.
+    """
+    key = cache_key(url, media_variant(kind, quality))
+    job_id = job_id or job_record(uid, msg, url, kind, quality)
+    started = time.perf_counter()
+    if draining:
+        await msg.edit_text("⏸ Bot qayta ishga tushirilmoqda — yuklash shundan keyin boshlanadi.")
+        return
+    task = asyncio.current_task()
+    active_jobs.add(task)
+    finished = True
     try:
-        # extract info first to check title
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get("title","")
-        if is_explicit_title(title):
+        job_state(job_id, "running")
+        c = cache_get(url, media_variant(kind, quality))
+        if cache_usable(c):
+            # an identical job finished while this one was posting its status message
+            leader, (status, data) = False, ("ok", c)
+        else:
+            leader, (status, data) = await single_flight(
+                key, msg, lambda job: fetch_media(job, uid, url, kind, quality, info),
+                admit=lambda: check_job_limit(uid))
+        if status == "error" and download_abort.is_set():
+            # the shared download was stopped by shutdown
+            finished = False
+            await park_job(job_id, msg)
+            return
+        if status == "explicit":
             banned = warn_add(uid, "Explicit title detected (auto)", source="auto")
             if banned:
                 await msg.edit_text("🚫 3 warnga yetib, 1 kunga banlandingiz.")
             else:
                 await msg.edit_text(f"⚠️ Nomaqbul nom topildi. ({user_warnings.get(uid,0)}/3)")
             return
-        # download
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = os.path.splitext(ydl.prepare_filename(info))[0] + ".mp3"
-        if not os.path.exists(filename):
+        if status == "missing":
             await msg.edit_text("❌ Fayl topilmadi.")
             return
-        await callback_query.message.reply_audio(audio=filename, caption=title)
-        cache_set(url, filename, "audio", title)
-        incr_stat(uid, "audio")
-        add_history(uid, "download_audio", url)
+        if status == "too_big":
+            await msg.edit_text(f"❗ Fayl juda katta (~{human_size(data)}, limit {human_size(MAX_FILE_SIZE)}).")
+            return
+        if status == "error":
+            if not leader:
+                await msg.edit_text(f"⚠️ Xatolik: {data}")
+            return
+        # the leader already uploaded; everyone else re-sends its file_id
+        if not leader and not await send_cached(msg, key, data, kind):
+            await msg.edit_text("❌ Fayl topilmadi.")
+            return
+        perf.observe("total" if leader else "joined", time.perf_counter() - started,
+                     url_extractor(url), media_variant(kind, quality))
+        incr_stat(uid, kind)
+        add_history(uid, f"download_{kind}", url)
+    except asyncio.CancelledError:
+        finished = False
+        await park_job(job_id, msg)
+        raise
+    except UserJobLimit:
+        await msg.edit_text("⏳ Oldingi yuklashingiz hali tugamagan, iltimos kuting.")
     except Exception as e:
         await msg.edit_text(f"⚠️ Xatolik: {e}")
+    finally:
+        active_jobs.discard(task)
+        if finished:
+            job_done(job_id)
 
-async def download_video(callback_query, url, quality):
-    uid = callback_query.from_user.id
-    msg = await callback_query.message.edit_text(f"🎬 Video ({quality}) yuklanmoqda... 0%")
-    def hook(d): asyncio.create_task(progress_hook(d, msg))
-    fmt = "bestvideo+bestaudio/best" if quality == "best" else f"bestvideo[height<={quality}]+bestaudio/best/best"
+async def fetch_media(job, uid, url, kind, quality=None, info=None):
+    # one metadata pass per job: title check + format plan + download
+    info = info or await get_info(url)
+    title = info.get("title","")
+    if is_explicit_info(info):
+        return "explicit", title
+    # choose formats up front instead of downloading something that won't fit
+    fmt, est = plan_format(info, kind, quality)
+    if fmt is None:
+        return "too_big", est
+    variant = media_variant(kind, quality)
+    extractor = url_extractor(url)
+    if worker_pool.size:
+        status, data = await worker_pool.run(uid, {
+            "key": job.key, "url": url, "kind": kind, "fmt": fmt, "title": title,
+            "chat": job.messages[0].chat.id, "info": yt_dlp.YoutubeDL.sanitize_info(info, True),
+        }, job.reporter.hook)
+        if status == "error":
+            raise RuntimeError(data)  # same path as a failure in this process
+        if status == "ok":
+            perf.observe("queue_wait", data["queue_wait"], extractor, variant)
+            perf.observe("download", data["download"], extractor, variant, data["bytes"])
+            download_timings.append({"extractor": extractor, "seconds": round(data["download"], 2),
+                                     "bytes": data["bytes"], "time": now_iso()})
+    else:
+        status, data = await transfer(
+            job.key, url, kind, fmt, info, [job.reporter.hook],
+            lambda opts, info: run_download(job.messages[0], uid, url, opts, info, variant),
+            lambda path: send_media(job.messages[0], kind, path, title))
+    if status != "ok":
+        return status, data
+    if "ffmpeg" in data:
+        perf.observe("ffmpeg", data["ffmpeg"], extractor, variant)
+    perf.observe("upload", data["upload"], extractor, variant, data["upload_bytes"])
+    return "ok", cache_set(url, variant, data["file"], kind, title, data["file_id"], data["file_unique_id"])
+
+async def transfer(key, url, kind, fmt, info, hooks, download, send):
+    """Download `fmt`, make it sendable and upload it; the same steps in-process and in a worker.
+
+    Returns (status, data); on "ok" data holds the kept file, its file_ids and stage timings.
+    """
     ydl_opts = {
         'format': fmt,
-        'outtmpl': 'video.%(ext)s',
-        'merge_output_format':'mp4',
         'quiet': True,
         'nocheckcertificate': True,
-        'progress_hooks': [hook]
+        'progress_hooks': hooks,
     }
-    try:
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get("title","")
-        if is_explicit_title(title):
-            banned = warn_add(uid, "Explicit title detected (auto)", source="auto")
-            if banned:
-                await msg.edit_text("🚫 3 warnga yetib, 1 kunga banlandingiz.")
-            else:
-                await msg.edit_text(f"⚠️ Nomaqbul nom topildi. ({user_warnings.get(uid,0)}/3)")
-            return
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-        if os.path.getsize(filename) > MAX_FILE_SIZE:
-            await msg.edit_text("❗ Fayl juda katta (2GB dan katta)."); os.remove(filename); return
-        await callback_query.message.reply_video(video=filename, caption=title)
-        cache_set(url, filename, "video", title)
-        incr_stat(uid, "video")
-        add_history(uid, "download_video", url)
-    except Exception as e:
-        await msg.edit_text(f"⚠️ Xatolik: {e}")
+    if kind == "video":
+        ydl_opts['merge_output_format'] = 'mp4'
+    data = {}
+    # download into a private workspace; fragments go away with it
+    async with job_workspace(workspace_name(key)) as workdir:
+        ydl_opts['outtmpl'] = os.path.join(workdir, '%(id)s.%(ext)s')
+        # merging the video+audio streams happens inside yt-dlp, so it counts as download time
+        info, filename = await download(ydl_opts, info)
+        if not os.path.exists(filename):
+            return "missing", None
+        if kind == "audio":
+            # the download worker is free again; remux/transcode runs in the ffmpeg pool
+            started = time.perf_counter()
+            filename = await prepare_audio(filename, info)
+            data["ffmpeg"] = time.perf_counter() - started
+        elif os.path.getsize(filename) > MAX_FILE_SIZE:
+            return "too_big", os.path.getsize(filename)
+        # a full copy when SCRATCH_DIR is tmpfs and MEDIA_DIR is on disk
+        filename = await run_blocking(keep_media, filename)
+    started = time.perf_counter()
+    sent = await send(filename)
+    data["upload"] = time.perf_counter() - started
+    data["upload_bytes"] = os.path.getsize(filename)
+    data["file"] = filename
+    data["file_id"], data["file_unique_id"] = sent_file_ids(sent, kind)
+    return "ok", data
 
 # full song search
-async def search_full_song(callback_query, url):
+async def search_full_song(callback_query, url, info=None):
     msg = await callback_query.message.edit_text("🔎 To'liq versiya qidirilmoqda...")
     try:
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get("title","")
-        query = re.sub(r'[^a-zA-Z0-9 ]','', title)
-        search_url = f"https://www.youtube.com/results?search_query={query}+official+audio"
-        resp = requests.get(search_url).text
-        ids = re.findall(r"watch\?v=(\S{11})", resp)
-        if not ids:
+        info = info or await get_info(url)
+        with perf.timer("search", url_extractor(url)):
+            video_id = await find_full_song(info)
+        if not video_id:
             await msg.edit_text("❌ To'liq musiqani topib bo'lmadi.")
             return
-        full_url = f"https://www.youtube.com/watch?v={ids[0]}"
+        full_url = f"https://www.youtube.com/watch?v={video_id}"
         await msg.edit_text("🎵 To'liq musiqani yuklanmoqda...")
         # reuse audio downloader by passing callback_query
         await download_audio(callback_query, full_url)
+    except asyncio.TimeoutError:
+        await msg.edit_text("⌛ Qidiruv juda uzoq davom etdi, keyinroq urinib ko'ring.")
     except Exception as e:
         await msg.edit_text(f"⚠️ Xatolik: {e}")
 
-USERS_FILE = "users.json"
-
 def load_users():
-    ensure_file(USERS_FILE, {})
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except:
-            return {}
+    return store.load("users", {})
+
+def save_users(users, uid=None):
+    # one row when we know who changed, otherwise everyone
+    with store.transaction():
+        for key in ([str(uid)] if uid is not None else list(users)):
+            store.put("users", key, users[key])
 
-def save_users(users):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+# ----------------- START BOT -----------------
+def init_state():
+    """Load the store, the history log and the ban index.
 
-# global dict
-users = load_users()
+    Only the dispatcher calls this: worker processes import this module too
+    and must not open (or write to) any of it.
+    """
+    global history_log
+    load_state()
+    history_log = HistoryLog(HISTORY_DIR, HISTORY_SEGMENT_BYTES)
+    migrate_history()
+    for uid, info in banned_users.items():
+        index_ban(uid, info)
+    expire_bans()
 
+async def main():
+    await app.start()
+    store.start()
+    worker_pool.start()
+    background = [asyncio.create_task(history_log.compactor()), asyncio.create_task(media_sweeper()),
+                  asyncio.create_task(ban_expirer())]
+    if PERF_PROM_FILE:
+        background.append(asyncio.create_task(perf_dumper()))
+    await resume_broadcast(app)
+    await resume_jobs(app)
+    try:
+        await idle()
+    finally:
+        # SIGTERM/SIGINT: finish what we can before the API goes away
+        await drain_jobs(DRAIN_TIMEOUT)
+        for task in background:
+            task.cancel()
+        worker_pool.stop()
+        await app.stop()
+        # whatever the flusher has not written yet
+        save_all()
 
-# ----------------- START BOT -----------------
 if __name__ == "__main__":
+    init_state()
     print("Bot ishga tushdi...")
+    clean_scratch()
     # ensure files saved
     save_all()
-    app.run()
\ No newline at end of file
+    app.run(main())
\ No newline at end of file
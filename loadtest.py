@@ -0,0 +1,461 @@
+# loadtest.py — offline load tests: the real handlers against a stub Telegram and a stub yt-dlp
+# usage: python loadtest.py [viral|broadcast|burst|moderation ...] [--users N] [--real-limits] [--json FILE]
+#
+# Nothing leaves the machine: pyrogram Message/CallbackQuery objects are bound to StubTelegram,
+# so message.reply / edit_text / reply_audio run unchanged, and yt_dlp.YoutubeDL is replaced by
+# StubYoutubeDL, which "downloads" the fixtures/*.mp4 files at a fixed speed.
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+START_DIR = os.getcwd()
+# kept out of the repo root: the bot's sweeper deletes "*.f<N>.*" fragments from its cwd
+FIXTURES = {
+    "audio": os.path.join(REPO, "fixtures", "audio_140.mp4"),
+    "360": os.path.join(REPO, "fixtures", "video_360.mp4"),
+    "720": os.path.join(REPO, "fixtures", "video_720.mp4"),
+}
+
+# the bot keeps bot.db / history/ / media/ in the cwd, so run in a scratch dir
+sys.path.insert(0, REPO)
+WORKDIR = tempfile.mkdtemp(prefix="loadtest-")
+os.chdir(WORKDIR)
+import yt_dlp
+from pyrogram.enums import ChatType
+from pyrogram.errors import UserIsBlocked
+from pyrogram.types import Audio, CallbackQuery, Chat, Message, User, Video
+import index
+
+
+# ----------------- STUBS -----------------
+class StubTelegram:
+    """Stands in for pyrogram.Client: every call takes `latency` seconds and is counted."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.blocked = set()  # chat ids that raise UserIsBlocked
+        self.calls = Counter()
+        self.ids = itertools.count(1)
+        self.last = {}        # chat_id -> last message sent to it (keyboards live there)
+        self.delivered = {}   # chat_id -> monotonic time its last media arrived
+
+    def message(self, chat_id, text=None, message_id=None, **media) -> Message:
+        return Message(client=self, id=message_id or next(self.ids), text=text,
+                       chat=Chat(id=chat_id, type=ChatType.PRIVATE), from_user=User(id=chat_id), **media)
+
+    async def _call(self, name, chat_id):
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+        if chat_id in self.blocked:
+            raise UserIsBlocked()
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._call("send_message", chat_id)
+        msg = self.message(chat_id, text, reply_markup=reply_markup)
+        self.last[chat_id] = msg
+        return msg
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        await self._call("edit_message_text", chat_id)
+        msg = self.message(chat_id, text, message_id, reply_markup=reply_markup)
+        self.last[chat_id] = msg
+        return msg
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        await self._call("send_audio", chat_id)
+        self.delivered[chat_id] = time.monotonic()
+        n = next(self.ids)
+        return self.message(chat_id, message_id=n, audio=Audio(file_id=f"A{n}", file_unique_id=f"a{n}", duration=200))
+
+    async def send_video(self, chat_id, video, **kwargs):
+        await self._call("send_video", chat_id)
+        self.delivered[chat_id] = time.monotonic()
+        n = next(self.ids)
+        return self.message(chat_id, message_id=n,
+                            video=Video(file_id=f"V{n}", file_unique_id=f"v{n}", width=640, height=360, duration=200))
+
+    async def answer_callback_query(self, callback_query_id, text=None, show_alert=None, **kwargs):
+        await self._call("answer_callback_query", None)
+        return True
+
+    async def get_users(self, user):
+        await self._call("get_users", None)
+        return User(id=int(str(user).lstrip("@")), username=str(user).lstrip("@"))
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._call("get_messages", chat_id)
+        return self.message(chat_id, message_id=message_ids)
+
+
+class StubYoutubeDL:
+    """yt_dlp.YoutubeDL stand-in: fixed metadata latency, downloads paced at `speed` bytes/s."""
+
+    metadata_latency = 0.2
+    speed = 20 * 1024 * 1024
+    chunk = 256 * 1024
+    extracts = 0
+    downloads = 0
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def metadata(url):
+        vid = url.rstrip("/").rsplit("/", 1)[-1].rsplit("=", 1)[-1][:11]
+        sizes = {k: os.path.getsize(v) for k, v in FIXTURES.items()}
+        return {
+            "id": vid, "title": f"Song {vid}", "description": "load test", "tags": ["music"],
+            "extractor_key": "Youtube", "webpage_url": url, "duration": 200, "ext": "mp4",
+            "formats": [
+                {"format_id": "140", "ext": "m4a", "vcodec": "none", "acodec": "mp4a.40.2", "abr": 128, "filesize": sizes["audio"]},
+                {"format_id": "18", "ext": "mp4", "height": 360, "vcodec": "avc1", "acodec": "mp4a.40.2", "filesize": sizes["360"]},
+                {"format_id": "136", "ext": "mp4", "height": 720, "vcodec": "avc1", "acodec": "none", "filesize": sizes["720"]},
+            ],
+        }
+
+    def extract_info(self, url, download=True):
+        StubYoutubeDL.extracts += 1
+        time.sleep(self.metadata_latency)
+        if url.startswith("ytsearch"):
+            return {"entries": [{"id": f"FULL{n:07d}", "title": f"Song (Official Audio) {n}", "duration": 200} for n in range(5)]}
+        info = self.metadata(url)
+        return self.process_ie_result(info, download) if download else info
+
+    def sanitize_info(self, info, remove_private_keys=False):
+        return info
+
+    def process_ie_result(self, info, download=True):
+        info = dict(info)
+        if "merge_output_format" in self.params:
+            fixture = FIXTURES["720"] if "136" in str(self.params.get("format")) else FIXTURES["360"]
+        else:
+            fixture, info["ext"], info["acodec"] = FIXTURES["audio"], "m4a", "mp4a.40.2"
+        if download:
+            StubYoutubeDL.downloads += 1
+            self._download(fixture, self.prepare_filename(info))
+        return info
+
+    def _download(self, src, dest):
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        total = os.path.getsize(src)
+        done = 0
+        with open(src, "rb") as fin, open(dest + ".part", "wb") as fout:
+            while True:
+                block = fin.read(self.chunk)
+                if not block:
+                    break
+                time.sleep(len(block) / self.speed)
+                fout.write(block)
+                done += len(block)
+                self._hook({"status": "downloading", "downloaded_bytes": done, "total_bytes": total,
+                            "speed": self.speed, "eta": (total - done) / self.speed,
+                            "_percent_str": f"{done * 100 / total:.1f}%"})
+        os.replace(dest + ".part", dest)
+        self._hook({"status": "finished", "downloaded_bytes": total, "total_bytes": total, "filename": dest})
+
+    def _hook(self, d):
+        for hook in self.params.get("progress_hooks", []):
+            hook(d)
+
+    def prepare_filename(self, info):
+        tmpl = self.params.get("outtmpl", "%(id)s.%(ext)s")
+        if isinstance(tmpl, dict):
+            tmpl = tmpl.get("default", "%(id)s.%(ext)s")
+        return tmpl % {"id": info["id"], "ext": info["ext"]}
+
+
+# ----------------- MEASUREMENT -----------------
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def tree_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def io_written():
+    # bytes handed to write(2) by this process (Linux); 0 elsewhere
+    try:
+        with open("/proc/self/io") as f:
+            return int(next(l for l in f if l.startswith("wchar:")).split()[1])
+    except (OSError, StopIteration):
+        return 0
+
+
+class LoopLag:
+    """Samples how late a 10 ms sleep wakes up: time the loop spent blocked by other work."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def _probe(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - t - self.interval)
+
+    def __enter__(self):
+        self.task = asyncio.create_task(self._probe())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+
+
+async def measure(name, tg, scenario):
+    """Run `scenario()` (returns per-request latencies) and collect the report."""
+    calls, extracts, downloads = Counter(tg.calls), StubYoutubeDL.extracts, StubYoutubeDL.downloads
+    disk, written = tree_bytes(WORKDIR), io_written()
+    started = time.perf_counter()
+    with LoopLag() as lag:
+        latencies, extra = await scenario()
+    wall = time.perf_counter() - started
+    index.save_all()
+    report = {
+        "scenario": name,
+        "requests": len(latencies),
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "latency_s": {p: round(percentile(latencies, int(p[1:])), 4) for p in ("p50", "p95", "p99")},
+        "latency_max_s": round(max(latencies, default=0), 4),
+        "loop_lag_ms": {"p99": round(percentile(lag.lags, 99) * 1e3, 2), "max": round(max(lag.lags, default=0) * 1e3, 2)},
+        "extracts": StubYoutubeDL.extracts - extracts,
+        "downloads": StubYoutubeDL.downloads - downloads,
+        "api_calls": dict(tg.calls - calls),
+        "disk_growth_bytes": tree_bytes(WORKDIR) - disk,
+        "bytes_written": io_written() - written,
+        **extra,
+    }
+    return report
+
+
+def print_report(r):
+    print(f"== {r['scenario']} ==")
+    print(f"requests {r['requests']}  wall {r['wall_s']}s  throughput {r['throughput_rps']} req/s")
+    lat = r["latency_s"]
+    print(f"latency p50 {lat['p50']}s  p95 {lat['p95']}s  p99 {lat['p99']}s  max {r['latency_max_s']}s")
+    print(f"loop lag p99 {r['loop_lag_ms']['p99']} ms  max {r['loop_lag_ms']['max']} ms")
+    print(f"yt-dlp: {r['extracts']} extract, {r['downloads']} download   api: {r['api_calls']}")
+    print(f"disk +{r['disk_growth_bytes'] / 1024:.0f} KB  written {r['bytes_written'] / 1024:.0f} KB")
+    extra = {k: v for k, v in r.items() if k not in (
+        "scenario", "requests", "wall_s", "throughput_rps", "latency_s", "latency_max_s", "loop_lag_ms",
+        "extracts", "downloads", "api_calls", "disk_growth_bytes", "bytes_written")}
+    if extra:
+        print("  ".join(f"{k} {v}" for k, v in extra.items()))
+    print()
+
+
+# ----------------- SCENARIOS -----------------
+uids = itertools.count(10_000_000)
+
+
+async def paste_and_press(tg, uid, url, button):
+    """One user: paste `url`, press `button` ("audio", "q_360", ...) on the keyboard they got."""
+    started = time.monotonic()
+    await index.handler_text(tg, tg.message(uid, url))
+    keyboard = tg.last[uid]
+    token = keyboard.reply_markup.inline_keyboard[0][0].callback_data.partition(":")[2]
+    cq = CallbackQuery(client=tg, id=str(uid), from_user=User(id=uid), chat_instance="lt",
+                       message=keyboard, data=f"{button}:{token}")
+    await index.callback_handler(tg, cq)
+    delivered = tg.delivered.get(uid)
+    return delivered - started if delivered and delivered >= started else None
+
+
+def viral(tg, users, spread=2.0):
+    """`users` people paste the same link within `spread` seconds and ask for the audio."""
+    async def run():
+        url = f"https://youtu.be/VIRAL{random.randrange(10 ** 6):06d}"
+
+        async def one(uid):
+            await asyncio.sleep(random.uniform(0, spread))
+            return await paste_and_press(tg, uid, url, "audio")
+
+        results = await asyncio.gather(*(one(next(uids)) for _ in range(users)))
+        latencies = [l for l in results if l is not None]
+        return latencies, {"delivered": f"{len(latencies)}/{users}"}
+    return run
+
+
+def broadcast(tg, users, blocked=0.01):
+    """/sendall to `users` recipients, `blocked` of them have blocked the bot."""
+    async def run():
+        admin = next(uids)
+        index.admins[str(admin)] = 3
+        recipients = [next(uids) for _ in range(users)]
+        for uid in recipients:
+            index.users[str(uid)] = {"username": None, "first_name": "lt", "last_name": "", "added": index.now_iso()}
+        tg.blocked.update(random.sample(recipients, int(users * blocked)))
+        sent_before = tg.calls["send_message"]
+        started = time.monotonic()
+        await index.cmd_sendall(tg, tg.message(admin, "/sendall load test"))
+        while index.broadcast_tasks:
+            await asyncio.gather(*index.broadcast_tasks)
+        wall = time.monotonic() - started
+        sent = tg.calls["send_message"] - sent_before
+        # per-recipient latency is not meaningful here; report the send rate instead
+        return [wall], {"messages": sent, "messages_per_s": round(sent / wall, 1),
+                        "pruned": users - sum(1 for u in recipients if str(u) in index.users)}
+    return run
+
+
+def burst(tg, users, texts=10, presses=30):
+    """Every user fires `texts` messages and `presses` button taps as fast as possible."""
+    async def run():
+        latencies = []
+        rejected = Counter()
+
+        async def one(uid):
+            await asyncio.sleep(random.uniform(0, 1))
+            for i in range(texts):
+                t = time.perf_counter()
+                await index.handler_text(tg, tg.message(uid, "salom" if i % 3 else f"https://youtu.be/SPAM{uid % 10 ** 7:07d}"))
+                latencies.append(time.perf_counter() - t)
+            for _ in range(presses):
+                t = time.perf_counter()
+                cq = CallbackQuery(client=tg, id=str(uid), from_user=User(id=uid), chat_instance="lt",
+                                   message=tg.message(uid, "kb"), data="video:expired")
+                await index.callback_handler(tg, cq)
+                latencies.append(time.perf_counter() - t)
+            rejected["banned" if index.is_user_banned(uid) else "free"] += 1
+
+        await asyncio.gather(*(one(next(uids)) for _ in range(users)))
+        return latencies, {"users": dict(rejected), "antispam_keys": len(index.text_limiter)}
+    return run
+
+
+def moderation(tg, users, history=20):
+    """An admin runs /warn (x3, the last one bans), /history, /unban, /ban and a filtered /history
+    for each of `users` people who already have `history` log entries."""
+    # seeded up front so the log writes do not count against the commands
+    admin = next(uids)
+    index.admins[str(admin)] = 3
+    targets = [next(uids) for _ in range(users)]
+    for uid in targets:
+        for i in range(history):
+            index.add_history(uid, "download_audio", f"https://youtu.be/HIST{i:07d}")
+    handlers = {"/warn": index.cmd_warn, "/ban": index.cmd_ban, "/unban": index.cmd_unban,
+                "/history": index.cmd_history}
+
+    async def run():
+        timings = {name: [] for name in handlers}
+
+        async def command(text):
+            name = text.split()[0]
+            t = time.perf_counter()
+            await handlers[name](tg, tg.message(admin, text))
+            timings[name].append(time.perf_counter() - t)
+
+        async def one(uid):
+            await asyncio.sleep(random.uniform(0, 1))
+            for _ in range(3):
+                await command(f"/warn @{uid} load test")
+            await command(f"/history @{uid}")
+            await command(f"/unban @{uid}")
+            await command(f"/ban @{uid} 5h load test")
+            await command(f"/history @{uid} event=ban")
+
+        await asyncio.gather(*(one(uid) for uid in targets))
+        t = time.perf_counter()
+        index.expire_bans()
+        expire = time.perf_counter() - t
+        return [l for v in timings.values() for l in v], {
+            "p95_ms": {name: round(percentile(v, 95) * 1e3, 2) for name, v in timings.items()},
+            "banned": sum(1 for uid in targets if index.is_user_banned(uid)),
+            "ban_heap": len(index.ban_heap),
+            "expire_ms": round(expire * 1e3, 3),
+        }
+    return run
+
+
+SCENARIOS = {
+    "viral": lambda tg, n: viral(tg, n or 1000),
+    "broadcast": lambda tg, n: broadcast(tg, n or 10_000),
+    "burst": lambda tg, n: burst(tg, n or 2000),
+    "moderation": lambda tg, n: moderation(tg, n or 1000),
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def main(args):
+    yt_dlp.YoutubeDL = StubYoutubeDL
+    StubYoutubeDL.metadata_latency = args.metadata_latency
+    StubYoutubeDL.speed = args.speed * 1024 * 1024
+    tg = StubTelegram(args.api_latency)
+    # the same outgoing limiter the real client is wrapped in
+    for name, prio in (("send_message", index.PRIO_HIGH), ("send_audio", index.PRIO_HIGH),
+                       ("send_video", index.PRIO_HIGH), ("edit_message_text", index.PRIO_NORMAL)):
+        setattr(tg, name, index.api_limiter.wrap(getattr(tg, name), prio))
+    if not args.real_limits:
+        # measure the bot's own overhead, not Telegram's 30 msg/s
+        index.api_limiter.bucket = index.TokenBucket(1e6, 1e6)
+        index.api_limiter.chat_rate = index.api_limiter.chat_burst = 1e6
+        index.BROADCAST_RATE = 1e6
+    index.init_state()
+    index.store.start()
+    reports = []
+    for name in args.scenarios or SCENARIOS:
+        random.seed(name)
+        report = await measure(name, tg, SCENARIOS[name](tg, args.users))
+        print_report(report)
+        reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load tests for index.py")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--users", type=int, default=0, help="users per scenario (default: per scenario)")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="seconds per Telegram call")
+    parser.add_argument("--metadata-latency", type=float, default=0.2, help="seconds per extract_info")
+    parser.add_argument("--speed", type=float, default=20, help="stub download speed, MB/s")
+    parser.add_argument("--real-limits", action="store_true", help="keep the configured API/broadcast rates")
+    parser.add_argument("--json", help="append the reports to this file (one JSON object per line)")
+    args = parser.parse_args()
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    try:
+        reports = asyncio.run(main(args))
+        if args.json:
+            with open(os.path.join(START_DIR, args.json), "a", encoding="utf-8") as f:
+                for r in reports:
+                    f.write(json.dumps({"revision": git_revision(), "time": index.now_iso(), **r}) + "\n")
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(WORKDIR, ignore_errors=True)